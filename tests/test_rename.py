@@ -3,12 +3,22 @@
 # Licensed under the MIT license
 # --------------------------------------------------------------------
 
+import io
 import os
 import re
+import sys
+import json
+import struct
+import time
+import zlib
 import shutil
+import subprocess
 import pytest
 
 package_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../usr/lib/renametoix')
+tools_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../tools')
+sys.path.insert(0, package_path)
+import crenametoix  # noqa
 
 
 class TestInitStream:
@@ -46,6 +56,552 @@ class TestInitStream:
         assert actual_list == expected_list
         self.files = expected_list
 
+    def create_renamer(self, *params, pattern=''):
+        arg_parser = crenametoix.get_argument_parser()
+        crenametoix.add_arguments(arg_parser)
+        arg_parser.add_argument("files", nargs="*")
+        renamer = crenametoix.PureConsoleRename(arg_parser.parse_args(list(params)))
+        renamer.add_files(sorted(os.path.join(self.work_path, filename)
+                                 for filename in self.files if filename.endswith(pattern)))
+        return renamer
+
+    def get_new_names(self, renamer):
+        return [os.path.basename(dst_file) for _, dst_file in renamer.renames]
+
+    def test_reorder_reuses_rendered_names(self):
+        renamer = self.create_renamer(pattern='.txt')
+        renamer.generate_new_names(1, False, False, '', '%0n-%0{upper}')
+        assert self.get_new_names(renamer) == ['01-DOC_A.txt', '02-D.txt', '03-DOC_B.txt']
+        rendered = dict(renamer.render_cache)
+        renamer.files.reverse()
+        renamer.files_list_store.reverse()
+        renamer.files_list_store[0][0] = False
+        renamer.generate_new_names(1, False, False, '', '%0n-%0{upper}')
+        assert self.get_new_names(renamer) == ['01-D.txt', '02-DOC_A.txt']
+        assert all(renamer.render_cache[f] is rendered[f] for f in rendered)
+
+    def test_external_changes_between_passes(self):
+        renamer = self.create_renamer(pattern='.txt')
+        renamer.generate_new_names(1, True, False, '^d$', 'x')
+        assert renamer.files_state[1] == crenametoix.STATE_RENAMED
+        with open(os.path.join(self.work_path, 'x.txt'), 'w') as f:
+            f.write('x')
+        renamer.generate_new_names(1, True, False, '^d$', 'x')
+        assert renamer.files_state[1] == crenametoix.STATE_ALREADY_EXISTS
+        filename = os.path.join(self.work_path, 'd.txt')
+        renamer.generate_new_names(1, True, False, '^d$', '%Y')
+        os.utime(filename, (0, time.mktime((2001, 6, 1, 0, 0, 0, 0, 0, -1))))
+        renamer.generate_new_names(1, True, False, '^d$', '%Y')
+        assert self.get_new_names(renamer) == ['2001.txt']
+
+    def test_jsonl_plan_output(self):
+        renamer = self.create_renamer('-format', 'jsonl', pattern='.txt')
+        renamer.output.stream = io.StringIO()
+        renamer.generate_new_names(1, True, False, '^[Dd]oc_.', 'x')
+        renamer.console_apply_renames(test_mode=True)
+        renamer.display_descriptions()
+        renamer.output.close()
+        records = [json.loads(line) for line in renamer.output.stream.getvalue().splitlines()]
+        assert [(os.path.basename(record['file']), record['state'], record['applied'])
+                for record in records] == [('Doc_a.txt', 'renamed', False),
+                                           ('d.txt', 'not-changed', False),
+                                           ('doc_b.txt', 'conflict', False)]
+        assert records[2]['conflicts_with'] == records[0]['file']
+        assert sorted(os.listdir(self.work_path)) == sorted(self.files)
+
+    def test_regex_timeout(self):
+        self.files.append('a' * 30 + 'b.txt')
+        with open(os.path.join(self.work_path, self.files[-1]), "w") as f:
+            f.write("x")
+        renamer = self.create_renamer('-regex-timeout', '0.2', pattern='.txt')
+        renamer.generate_new_names(1, True, False, '^(a+)+$', 'x')
+        index = renamer.files.index(os.path.join(self.work_path, self.files[-1]))
+        assert renamer.files_state[index] == 'Regular expression timeout'
+        assert renamer.slow_regex_files[0][0] == renamer.files[index]
+        assert self.get_new_names(renamer) == []
+
+    def test_on_conflict_suffix(self):
+        renamer = self.create_renamer('-on-conflict', 'suffix', pattern='.txt')
+        renamer.generate_new_names(1, True, False, '^.*$', 'd')
+        assert self.get_new_names(renamer) == ['d_1.txt', 'd_2.txt']
+        assert renamer.files_state == [crenametoix.STATE_RENAMED, crenametoix.STATE_NOT_CHANGED,
+                                       crenametoix.STATE_RENAMED]
+        with open(os.path.join(self.work_path, 'd_1.txt'), 'w') as f:
+            f.write('x')
+        renamer.generate_new_names(1, True, False, '^.*$', 'd')
+        assert self.get_new_names(renamer) == ['d_2.txt', 'd_3.txt']
+
+    def test_save_and_apply_plan(self):
+        plan_file = os.path.join(self.work_path, 'plan.jsonl')
+        renamer = self.create_renamer('-save-plan', plan_file, '-format', 'null', pattern='.jpg')
+        renamer.generate_new_names(1, False, False, 'IMG_', 'photo-')
+        renamer.save_plan(plan_file)
+        with open(os.path.join(self.work_path, 'IMG_503.jpg'), 'a') as f:
+            f.write('changed')
+        renamer = self.create_renamer('-apply-plan', plan_file, '-format', 'null', pattern='-')
+        renamer.console_mode_rename()
+        assert renamer.rename_count == 1
+        assert renamer.files_state[1] == 'Changed since the plan was saved'
+        assert os.path.exists(os.path.join(self.work_path, 'photo-501.jpg'))
+
+    def test_pipeline(self):
+        renamer = self.create_renamer(pattern='.jpg')
+        renamer.set_pipeline([{'find': 'IMG_', 'replace': ''},
+                              {'find': '^(\\d+)$', 'reg-ex': True, 'replace': '%0n-\\1'}])
+        renamer.generate_new_names(1, False, False, '5', 'x')
+        assert self.get_new_names(renamer) == ['01-x01.jpg', '02-x03.jpg']
+
+    def test_parallel_rendering(self, monkeypatch):
+        monkeypatch.setattr(crenametoix, 'PARALLEL_MIN_FILES', 0)
+        monkeypatch.setattr(crenametoix, 'PARALLEL_CHUNK_SIZE', 2)
+        monkeypatch.setattr(crenametoix, 'SLOW_REGEX_TIME', 0)
+        replace = '%0n-%:{m[1].upper()}-\\1'
+        serial_renamer = self.create_renamer()
+        serial_renamer.generate_new_names(3, True, False, '^(.)', replace)
+        renamer = self.create_renamer('-jobs', '3', '-stats')
+        renamer.generate_new_names(3, True, False, '^(.)', replace)
+        assert renamer.renames == serial_renamer.renames
+        assert 'render_file_name' in renamer.stats.phases
+        assert 'render_cache_misses' not in renamer.stats.counters
+        assert renamer.files_state == serial_renamer.files_state
+        assert renamer.next_index == serial_renamer.next_index
+        assert sorted(filename for filename, _ in renamer.slow_regex_files) == renamer.files
+
+    def test_move_between_file_systems(self, monkeypatch):
+        rename = os.rename
+
+        def cross_device_rename(src_file, dst_file):
+            if os.path.basename(src_file) != os.path.basename(dst_file):
+                raise OSError(crenametoix.errno.EXDEV, 'Invalid cross-device link')
+            rename(src_file, dst_file)
+
+        monkeypatch.setattr(crenametoix.os, 'rename', cross_device_rename)
+        src_file = os.path.join(self.work_path, 'd.txt')
+        os.chmod(src_file, 0o640)
+        os.utime(src_file, (1000000000, 1000000000))
+        dst_file = os.path.join(self.work_path, 'moved.txt')
+        assert crenametoix.move_file(src_file, dst_file) != 'rename'
+        assert not os.path.exists(src_file)
+        with open(dst_file) as f:
+            assert f.read() == 'x' * 5
+        assert os.stat(dst_file).st_mode & 0o777 == 0o640
+        assert os.stat(dst_file).st_mtime == 1000000000
+
+    def test_dir_fd_cache(self):
+        dir_fds = crenametoix.DirFdCache(crenametoix.NullStats(), max_size=2)
+        folder = os.path.join(self.work_path, 'a')
+        os.makedirs(os.path.join(folder, 'b'))
+        open(os.path.join(folder, 'b', 'f.txt'), 'w').close()
+        assert dir_fds.exists(os.path.join(folder, 'b', 'f.txt'))
+        assert dir_fds.listdir(folder) == ['b']
+        assert dir_fds.exists(os.path.join(self.work_path, 'd.txt'))
+        assert list(dir_fds.fds) == [folder, str(self.work_path)]
+        assert dir_fds.exists(os.path.join(folder, 'b', 'f.txt'))
+        dir_fds.rename(os.path.join(folder, 'b'), os.path.join(folder, 'c'))
+        assert not dir_fds.exists(os.path.join(folder, 'b', 'f.txt'))
+        assert dir_fds.exists(os.path.join(folder, 'c', 'f.txt'))
+        dir_fds.clear()
+        assert not dir_fds.fds and not dir_fds.open_inside
+
+    def test_file_uris(self):
+        filename = os.path.join(self.work_path, 'my 100% doc.txt')
+        open(filename, 'w').close()
+        renamer = self.create_renamer(pattern='.pdf')
+        renamer.add_files(['file://' + filename.replace('%', '%25').replace(' ', '%20')])
+        assert renamer.files == [os.path.join(self.work_path, 'e.pdf'), filename]
+
+    def test_durable_batches(self, monkeypatch):
+        monkeypatch.setattr(crenametoix, 'DURABLE_BATCH_SIZE', 2)
+        renamer = self.create_renamer('-durable', '-stats', '-format', 'null', pattern='.txt')
+        renamer.generate_new_names(1, True, False, '^', 'r-')
+        renamer.console_apply_renames()
+        assert renamer.rename_count == 3
+        assert renamer.stats.counters['fsync'] == 2
+        assert not renamer.durable_folders and renamer.durable_count == 0
+
+    def test_durable_revert_script(self):
+        home_path = os.path.join(self.work_path, 'home')
+        result = subprocess.run([sys.executable, f'{package_path}/renametoix.py', '-console',
+                                 '-allow-revert', '-durable', '-stats', '-format', 'null',
+                                 '-find', 'IMG_', '-replace', 'photo-',
+                                 os.path.join(self.work_path, 'IMG_501.jpg')],
+                                env=dict(os.environ, HOME=home_path),
+                                capture_output=True, text=True, check=True)
+        # the renamed files and the revert scripts folders on the batch, and the revert
+        # scripts folder again after revert-rename.sh is written
+        assert re.search(r'fsync +3\n', result.stderr)
+        with open(os.path.join(home_path, '.revert-renames', 'revert-rename.sh')) as f:
+            assert os.path.exists(f.read().strip())
+
+    def test_lazy_plugin_prepare(self):
+        renamer = self.create_renamer('-find', '50', pattern='')
+        renamer.files_list_store[renamer.files.index(
+            os.path.join(self.work_path, 'IMG_503.jpg'))][0] = False
+        renamer.init_plugins('%!{img:%width%}', lambda is_sync: None, True)
+        plugin = renamer.plugins['img']
+        assert list(plugin.worker.files) == [os.path.join(self.work_path, 'IMG_501.jpg')]
+        unticked_file = os.path.join(self.work_path, 'IMG_503.jpg')
+        with pytest.raises(Exception, match='Unsupported image format'):
+            renamer.run_plugin_expr('img', '%width%', unticked_file, [])
+        assert unticked_file in plugin.prepared and unticked_file in plugin.worker.files
+
+    def test_queued_plugin_prepare(self):
+        renamer = self.create_renamer('-find', '501', pattern='')
+        renamer.queue_lazy_prepares = True
+        renamer.init_plugins('%!{img:%width%}', lambda is_sync: None, True)
+        plugin = renamer.plugins['img']
+        unticked_file = os.path.join(self.work_path, 'IMG_503.jpg')
+        with pytest.raises(Exception, match='Waiting for the plugin'):
+            renamer.run_plugin_expr('img', '%width%', unticked_file, [])
+        assert unticked_file not in plugin.prepared and list(plugin.queued_files) == [
+            unticked_file]
+        renamer.init_plugins('%!{img:%width%}', lambda is_sync: None, True)
+        assert unticked_file in plugin.prepared and unticked_file in plugin.worker.files
+        assert not plugin.queued_files
+
+    def test_plugin_candidates_without_re2(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, 're2', None)
+        renamer = self.create_renamer('-reg-ex', '-regex-engine', 're2', '-find', '501',
+                                      pattern='.jpg')
+        renamer.init_plugins('%!{img:%width%}', lambda is_sync: None, True)
+        assert set(renamer.plugins['img'].prepared) == set(renamer.files)
+
+    def test_stats_file(self):
+        stats_file = os.path.join(self.work_path, 'stats.json')
+        renamer = self.create_renamer('-format', 'null', '-stats-file', stats_file, pattern='.jpg')
+        renamer.args.find = 'IMG_'
+        renamer.args.replace = 'p%0n-'
+        renamer.console_mode_rename_ready(True)
+        renamer.stats.write(renamer.args)
+        with open(stats_file) as f:
+            stats = json.load(f)
+        assert set(stats['phases']) >= {'generate_new_names', 'apply_renames', 'render_file_name'}
+        assert stats['counters']['renames'] == 2
+        assert stats['counters']['render_cache_misses'] == 2
+
+    def eval_plugin(self, plugin_name, macro, files):
+        # prepares the files on a new worker, returns the result or the error of each file
+        worker = crenametoix.plugin_registry.create_worker(plugin_name)
+        filenames = []
+        for basename, data in files.items():
+            filenames.append(os.path.join(self.work_path, basename))
+            with open(filenames[-1], 'wb') as f:
+                f.write(data)
+        worker.prepare(filenames)
+        results = {}
+        for filename in filenames:
+            try:
+                results[os.path.basename(filename)] = worker.eval_expr(macro, filename, [])
+            except Exception as e:
+                results[os.path.basename(filename)] = f'error: {e}'
+        return results
+
+    def test_img_plugin(self):
+        def jpeg(orientation, fill=b''):
+            entry = struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0)
+            app1 = b'Exif\0\0II*\0' + struct.pack('<IH', 8, 1) + entry + bytes(4)
+            sof = struct.pack('>BHHB', 8, 20, 30, 3) + bytes(9)
+            return b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + fill \
+                + b'\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof + b'\xff\xd9'
+
+        riff = b'RIFF' + bytes(4) + b'WEBP'
+        files = {
+            'a.png': b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR'
+            + struct.pack('>II', 30, 20) + bytes(9),
+            'b.gif': b'GIF89a' + struct.pack('<HH', 20, 30) + bytes(22),
+            'c.webp': riff + b'VP8 ' + bytes(7) + b'\x9d\x01\x2a'
+            + struct.pack('<HH', 0x4000 | 30, 30) + bytes(2),
+            'd.webp': riff + b'VP8L' + bytes(4) + b'\x2f'
+            + struct.pack('<I', (20 - 1) | (30 - 1) << 14) + bytes(7),
+            'e.webp': riff + b'VP8X' + bytes(8) + (30 - 1).to_bytes(3, 'little')
+            + (20 - 1).to_bytes(3, 'little') + bytes(2),
+            'f.jpg': jpeg(1, b'\xff\xff'),
+            'g.png': b'\x89PNG\r\n\x1a\n' + bytes(4),
+            'h.gif': b'GIF89a\x14',
+            'i.jpg': jpeg(1)[:30],
+        }
+        for orientation in range(5, 9):
+            files[f'r{orientation}.jpg'] = jpeg(orientation)
+        results = self.eval_plugin('img', '%width%x%height%-%orientation%', files)
+        assert results == {
+            'a.png': '30x20-landscape', 'b.gif': '20x30-portrait', 'c.webp': '30x30-square',
+            'd.webp': '20x30-portrait', 'e.webp': '30x20-landscape',
+            'f.jpg': '30x20-landscape',
+            'g.png': 'error: Unsupported image format',
+            'h.gif': 'error: unpack requires a buffer of 4 bytes',
+            'i.jpg': 'error: unpack requires a buffer of 2 bytes',
+            **{f'r{orientation}.jpg': '20x30-portrait' for orientation in range(5, 9)}
+        }
+
+    def test_exif_plugin(self):
+        sys.path.insert(0, tools_path)
+        from benchmark import build_exif_jpeg
+        jpeg = build_exif_jpeg('Canon', 'EOS', '2024:05:06 07:08:09')
+        files = {
+            'a.jpg': jpeg,
+            'b.jpg': jpeg[:2] + b'\xff\xff' + jpeg[2:],
+            'c.jpg': build_exif_jpeg('Nikon', 'Z 6', '2023:01:02 03:04:05'),
+            # TIFF files start with the EXIF data, after the APP1 header
+            'd.tif': jpeg[12:-2],
+            'e.jpg': b'\xff\xd8\xff\xd9',
+            'f.jpg': jpeg[:40],
+            'g.jpg': b'GIF89a',
+            'h.jpg': build_exif_jpeg('Canon', 'EOS', 'unknown'),
+        }
+        results = self.eval_plugin('exif', '%date:%Y%m%d%-%make%-%model%', files)
+        assert results == {
+            'a.jpg': '20240506-Canon-EOS', 'b.jpg': '20240506-Canon-EOS',
+            'c.jpg': '20230102-Nikon-Z 6', 'd.tif': '20240506-Canon-EOS',
+            'e.jpg': 'error: No EXIF data',
+            'f.jpg': 'error: unpack requires a buffer of 8 bytes',
+            'g.jpg': 'error: Unsupported file format', 'h.jpg': 'error: No EXIF date'
+        }
+
+    def test_media_plugin(self):
+        def syncsafe(size):
+            return bytes([(size >> shift) & 0x7F for shift in [21, 14, 7, 0]])
+
+        def id3(version, frames, flags=0, extended_header=b''):
+            # with the unsynchronisation flag, a 0x00 is inserted after each 0xff, on the
+            # frames data in v2.4, and on the whole tag before v2.4
+            data = b''
+            for frame_id, text in frames:
+                if version == 4 and flags & 0x80:
+                    text = text.replace(b'\xff', b'\xff\x00')
+                size = syncsafe(len(text)) if version == 4 else struct.pack('>I', len(text))
+                data += frame_id + size + bytes(2) + text
+            data = extended_header + data
+            if version < 4 and flags & 0x80:
+                data = data.replace(b'\xff', b'\xff\x00')
+            return b'ID3' + bytes([version, 0, flags]) + syncsafe(len(data)) + data
+
+        def atom(atom_type, payload):
+            return struct.pack('>I', len(payload) + 8) + atom_type + payload
+
+        frames = [(b'TPE1', b'\0Artist'), (b'TIT2', b'\0Title'), (b'TRCK', b'\x003/10')]
+        ilst = atom(b'\xa9ART', atom(b'data', bytes(8) + b'Artist')) \
+            + atom(b'\xa9nam', atom(b'data', bytes(8) + b'Title')) \
+            + atom(b'trkn', atom(b'data', bytes(8) + struct.pack('>HHHH', 0, 5, 12, 0)))
+        stream_info = bytes(10) + (44100 << 44 | 441000).to_bytes(8, 'big') + bytes(16)
+        comments = [b'ARTIST=Artist', b'TITLE=Title', b'TRACKNUMBER=7']
+        vorbis_comment = struct.pack('<I', 6) + b'vendor' + struct.pack('<I', len(comments)) \
+            + b''.join(struct.pack('<I', len(comment)) + comment for comment in comments)
+        files = {
+            'a.mp3': id3(3, frames),
+            'b.mp3': id3(3, frames, 0x40, struct.pack('>IHI', 6, 0, 0)),
+            'c.mp3': id3(4, frames),
+            'd.mp3': id3(4, frames, 0x40, syncsafe(6) + b'\x01\x00'),
+            'e.mp3': id3(3, [(b'TIT2', b'\0Title\xff')] + frames[::2], 0x80),
+            'e4.mp3': id3(4, [(b'TIT2', b'\0Title\xff')] + frames[::2], 0x80),
+            'f.flac': b'fLaC' + b'\x00' + len(stream_info).to_bytes(3, 'big') + stream_info
+            + b'\x84' + len(vorbis_comment).to_bytes(3, 'big') + vorbis_comment,
+            'g.m4a': atom(b'ftyp', b'M4A \0\0\0\0') + atom(b'moov', atom(
+                b'mvhd', bytes(12) + struct.pack('>II', 1000, 3000) + bytes(80))
+                + atom(b'udta', atom(b'meta', bytes(4) + atom(b'ilst', ilst)))),
+        }
+        results = self.eval_plugin('media', '%track% - %artist% - %title% (%duration%)', files)
+        assert results == {
+            'a.mp3': '03 - Artist - Title ()', 'b.mp3': '03 - Artist - Title ()',
+            'c.mp3': '03 - Artist - Title ()', 'd.mp3': '03 - Artist - Title ()',
+            'e.mp3': '03 - Artist - Title\xff ()', 'e4.mp3': '03 - Artist - Title\xff ()',
+            'f.flac': '07 - Artist - Title (10)',
+            'g.m4a': '05 - Artist - Title (3)',
+        }
+
+    def test_pdf_plugin(self):
+        def obj(num, body, stream=None):
+            if stream is None:
+                return b'%d 0 obj\n%s\nendobj\n' % (num, body)
+            return b'%d 0 obj\n<< %s /Length %d >>\nstream\n%s\nendstream\nendobj\n' % (
+                num, body, len(stream), stream)
+
+        def pdf(objects, trailer, data=b'%PDF-1.4\n'):
+            # appends the objects and a classic xref table, returns the data and the xref offset
+            offsets = {}
+            for num, chunk in objects:
+                offsets[num] = len(data)
+                data += chunk
+            xref = len(data)
+            data += b'xref\n' + b''.join(b'%d 1\n%010d 00000 n \n' % (num, offset)
+                                         for num, offset in offsets.items())
+            data += b'trailer\n<< /Size 9 %s >>\nstartxref\n%d\n%%%%EOF\n' % (trailer, xref)
+            return data, xref
+
+        def xref_stream(num, entries, body, predictor=False):
+            rows = [bytes([kind]) + offset.to_bytes(2, 'big') + bytes([index])
+                    for kind, offset, index in entries]
+            if predictor:
+                # png up predictor, each row has the difference to the previous row
+                rows = [b'\x02' + bytes((a - b) & 0xFF for a, b in zip(row, previous))
+                        for row, previous in zip(rows, [bytes(4)] + rows)]
+                body += b' /Filter /FlateDecode /DecodeParms << /Columns 4 /Predictor 12 >>'
+            stream = b''.join(rows)
+            return obj(num, b'/Type /XRef /W [1 2 1] %s' % body,
+                       zlib.compress(stream) if predictor else stream)
+
+        catalog = obj(1, b'<< /Type /Catalog >>')
+        info = obj(2, b'<< /Title (Report) /Author (Author) /CreationDate (D:20210304120000) >>')
+        trailer = b'/Root 1 0 R /Info 2 0 R'
+        classic, xref = pdf([(1, catalog), (2, info)], trailer)
+        incremental = pdf([(2, obj(2, b'<< /Title <FEFF004E00650077> /Author (- Author;) >>'))],
+                          trailer + b' /Prev %d' % xref, classic)[0]
+        object_stream = obj(3, b'/Type /ObjStm /N 1 /First 4 /Filter /FlateDecode', zlib.compress(
+            b'2 0 << /Title (Stream) /CreationDate (D:2022) >>'))
+        # the xref stream is the first object, at the offset 9
+        hybrid = pdf([(5, xref_stream(5, [(2, 3, 0)], b'/Size 3 /Index [2 1]')), (1, catalog),
+                      (3, object_stream)], trailer + b' /XRefStm 9', b'%PDF-1.5\n')[0]
+        stream = b'%PDF-1.5\n' + catalog + object_stream
+        offsets = [len(b'%PDF-1.5\n'), len(b'%PDF-1.5\n' + catalog), len(stream)]
+        stream += xref_stream(4, [(0, 0, 0), (1, offsets[0], 0), (2, 3, 0), (1, offsets[1], 0),
+                                  (1, offsets[2], 0)], b'/Size 5 ' + trailer, True)
+        stream += b'startxref\n%d\n%%%%EOF\n' % offsets[2]
+        xmp = b'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">Xmp &amp; Title</rdf:li>'
+        metadata_catalog = obj(1, b'<< /Type /Catalog /Metadata 3 0 R >>')
+        no_title = obj(2, b'<< /Author (Author) /CreationDate (D:20210304) >>')
+        # the title hex string crosses the end of the first object read
+        long_info = obj(2, b'<< /Producer (%s) /Title <%s> >>' % (
+            b'x' * 4060, b'Long Title'.hex().encode()))
+        files = {
+            'classic.pdf': classic,
+            'incremental.pdf': incremental,
+            'hybrid.pdf': hybrid,
+            'stream.pdf': stream,
+            'xmp.pdf': pdf([(1, metadata_catalog), (2, no_title), (3, obj(3, b'', xmp))],
+                           trailer)[0],
+            'broken_xmp.pdf': pdf([(1, metadata_catalog), (2, no_title),
+                                   (3, obj(3, b'/Filter /FlateDecode', b'not zlib'))], trailer)[0],
+            'long.pdf': pdf([(1, catalog), (2, long_info)], trailer)[0],
+            'encrypted.pdf': pdf([(1, catalog), (2, info)], trailer + b' /Encrypt 2 0 R')[0],
+            'truncated.pdf': classic[:-40],
+            'bad_offset.pdf': classic.replace(b'startxref\n%d' % xref, b'startxref\n9999'),
+        }
+        results = self.eval_plugin('pdf', '%created% - %title% - %author%', files)
+        assert results == {
+            'classic.pdf': '2021-03-04 - Report - Author',
+            'incremental.pdf': ' - New - Author',
+            'hybrid.pdf': '2022 - Stream - ',
+            'stream.pdf': '2022 - Stream - ',
+            'xmp.pdf': '2021-03-04 - Xmp & Title - Author',
+            'broken_xmp.pdf': '2021-03-04 -  - Author',
+            'long.pdf': ' - Long Title - ',
+            'encrypted.pdf': 'error: Encrypted PDF',
+            'truncated.pdf': 'error: No startxref',
+            'bad_offset.pdf': 'error: Invalid object offset',
+        }
+
+    def test_plugin_registry(self):
+        plugins_path = os.path.join(self.work_path, 'plugins')
+        os.makedirs(plugins_path)
+        with open(os.path.join(plugins_path, 'broken.py'), 'w') as f:
+            f.write('PLUGIN_INFO = {"fields": ["name"]}\nimport missing_module\n')
+        with open(os.path.join(plugins_path, 'meta.py'), 'w') as f:
+            f.write('PLUGIN_INFO = {"fields": ["a"], "description": "Meta", "extensions": [".txt"],'
+                    ' "is_slow": False}\n\n'
+                    'class Worker:\n'
+                    '    def get_extensions(self):\n        return []\n\n'
+                    '    def is_slow(self):\n        return True\n\n'
+                    'def get_worker():\n    return Worker()\n')
+        registry = crenametoix.PluginRegistry(plugins_path)
+        assert registry.get_fields_description('%!{broken:%name%}') == 'broken: %name%'
+        assert 'renametoix_plugin_broken' not in sys.modules
+        plugin = crenametoix.Plugin('broken', registry)
+        assert plugin.worker is None and 'missing_module' in plugin.error
+        assert registry.errors == {'broken': plugin.error}
+        assert registry.get_fields_description('%!{meta:%a%}') == 'meta: %a% - Meta'
+        plugin = crenametoix.Plugin('meta', registry)
+        plugin.set_new_files(['a.txt', 'b.jpg'])
+        assert plugin.new_files == ['a.txt'] and not plugin.is_slow
+
+    def test_daemon_jobs(self):
+        socket_name = os.path.join(self.work_path, 'renametoix.sock')
+        daemon = subprocess.Popen([sys.executable, f'{package_path}/crenametoix.py',
+                                   '-serve', socket_name])
+        try:
+            for _ in range(50):
+                if os.path.exists(socket_name):
+                    break
+                time.sleep(0.1)
+            assert os.stat(socket_name).st_mode & 0o777 == 0o600
+            for find, replace in [['IMG_', 'photo-'], ['photo-', 'p%0n-']]:
+                subprocess.run([sys.executable, f'{package_path}/crenametoix.py', '-connect',
+                                socket_name, '-find', find, '-replace', replace,
+                                *[os.path.join(self.work_path, filename) for filename in
+                                  sorted(os.listdir(self.work_path))
+                                  if filename.endswith('.jpg')]], check=True)
+            assert sorted(os.listdir(self.work_path)) == sorted(
+                ['p01-501.jpg', 'p02-503.jpg', 'Doc_a.txt', 'doc_b.txt', 'd.txt', 'e.pdf',
+                 'renametoix.sock'])
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    def test_gio_mover(self, monkeypatch):
+        monkeypatch.setenv('GIO_USE_VFS', 'local')
+        pytest.importorskip('gi')
+        from giomover import GioMover, Gio
+        progress = []
+        mover = GioMover(2, lambda *args: progress.append(args))
+        os.makedirs(os.path.join(self.work_path, 'moved'))
+
+        def rename(src, dst):
+            src_file = os.path.join(self.work_path, src)
+            dst_file = os.path.join(self.work_path, dst)
+            return [src_file, dst_file, Gio.File.new_for_path(src_file),
+                    Gio.File.new_for_path(dst_file), True]
+
+        results = mover.move_all([rename('IMG_501.jpg', 'photo-501.jpg'),
+                                  rename('d.txt', 'moved/d.txt'),
+                                  rename('missing.txt', 'found.txt')])
+        assert [result[5] is None for result in results] == [True, True, False]
+        assert sorted(os.listdir(self.work_path)) == sorted(
+            ['photo-501.jpg', 'IMG_503.jpg', 'Doc_a.txt', 'doc_b.txt', 'moved', 'e.pdf'])
+        assert os.listdir(os.path.join(self.work_path, 'moved')) == ['d.txt']
+        assert sorted(done for done, _, _ in progress) == [1, 2, 3]
+        assert all(total == 3 for _, total, _ in progress)
+        progress.clear()
+        _, _, g_source, g_dest, _ = rename('e.pdf', 'f.pdf')
+        mover.copy_stream(g_source, g_dest, 'copy')
+        assert progress[-1][2] == 5
+        with open(os.path.join(self.work_path, 'f.pdf')) as f:
+            assert f.read() == 'x' * 5
+
+    def test_watch_mode(self):
+        watch_path = os.path.join(self.work_path, 'watch')
+        os.makedirs(watch_path)
+        watcher = subprocess.Popen([sys.executable, f'{package_path}/crenametoix.py', '-watch',
+                                    watch_path, '-find', 'IMG_', '-replace', 'photo-'],
+                                   stdout=subprocess.DEVNULL)
+        try:
+            time.sleep(0.5)
+            for filename in ['IMG_1.jpg', 'IMG_2.jpg']:
+                with open(os.path.join(watch_path, filename), 'w') as f:
+                    f.write('x')
+            for _ in range(50):
+                if sorted(os.listdir(watch_path)) == ['photo-1.jpg', 'photo-2.jpg']:
+                    break
+                time.sleep(0.1)
+            assert sorted(os.listdir(watch_path)) == ['photo-1.jpg', 'photo-2.jpg']
+        finally:
+            watcher.terminate()
+            watcher.wait()
+
+    def test_inotify_events(self):
+        watcher = crenametoix.InotifyWatcher(str(self.work_path))
+        watcher.close()
+
+        def event(mask, name=b''):
+            name = name + b'\0' * (-len(name) % 16)
+            return crenametoix.INOTIFY_EVENT.pack(1, mask, 0, len(name)) + name
+
+        names = watcher.parse_names(event(crenametoix.IN_CLOSE_WRITE, b'a.txt')
+                                    + event(crenametoix.IN_CLOSE_WRITE)
+                                    + event(crenametoix.IN_IGNORED)
+                                    + event(crenametoix.IN_MOVED_TO, b'b.txt'))
+        assert names == ['a.txt', 'b.txt']
+        assert not watcher.overflowed
+        assert watcher.parse_names(event(crenametoix.IN_Q_OVERFLOW)) == []
+        assert watcher.overflowed
+
     def test_rename(self):
         self.call('oc', 'C', changes=lambda name, _: name.replace('oc', 'C'))
         self.call('', 'prefix-%B', pattern='*.txt',
@@ -0,0 +1,70 @@
+# --------------------------------------------------------------------
+# Copyright (c) 2024 Alexandre Bento Freire. All rights reserved.
+# Licensed under the MIT license
+# --------------------------------------------------------------------
+
+import os
+import re
+import sys
+import subprocess
+import pytest
+
+package_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../usr/lib/renametoix')
+
+# Modules that only the GUI requires
+GUI_MODULES = ['gi', 'yaml', 'setproctitle']
+# Modules imported only by the daemon, the watch mode, the parallel rendering,
+# the plugins registry, the regex timeout or the hash conflict policy
+LAZY_MODULES = ['socket', 'socketserver', 'select', 'ctypes', 'multiprocessing', 'concurrent',
+                'ast', 'signal', 'hashlib']
+# Modules imported only when a plugin macro is used: the plugins discovery and the plugins,
+# that are loaded with this prefix
+PLUGIN_MODULES = ['importlib.metadata']
+PLUGIN_MODULE_PREFIX = 'renametoix_plugin_'
+
+
+class TestStartup:
+
+    @pytest.fixture(autouse=True)
+    def setup_and_teardown(self, tmpdir):
+        self.work_path = str(tmpdir)
+        self.filename = os.path.join(self.work_path, 'a.txt')
+        with open(self.filename, "w") as f:
+            f.write("x")
+        # as on an installed package, the imported modules are already compiled,
+        # the cache is kept outside the source tree
+        self.env = dict(os.environ, HOME=self.work_path,
+                        PYTHONPYCACHEPREFIX=os.path.join(self.work_path, 'pycache'))
+        subprocess.run([sys.executable, '-m', 'compileall', '-q', '-l', package_path],
+                       env=self.env, check=True)
+        yield
+
+    def get_imports(self, script, *params):
+        result = subprocess.run([sys.executable, '-X', 'importtime',
+                                 os.path.join(package_path, script), *params],
+                                env=self.env, capture_output=True, text=True)
+        imports = set()
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+ \|\s+\d+ \| *(\S+)', line)
+            if match:
+                imports.add(match.group(1))
+        assert imports
+        return imports
+
+    def check_imports(self, imports):
+        top_level_modules = set(name.split('.')[0] for name in imports)
+        assert not top_level_modules.intersection(GUI_MODULES)
+        assert not top_level_modules.intersection(LAZY_MODULES)
+        assert not imports.intersection(PLUGIN_MODULES)
+        assert not [name for name in imports if name.startswith(PLUGIN_MODULE_PREFIX)]
+
+    def test_console_imports(self):
+        self.check_imports(self.get_imports('renametoix.py', '-console', '-test-mode',
+                                            '-find', 'a', '-replace', 'b', self.filename))
+
+    def test_revert_last_imports(self):
+        self.check_imports(self.get_imports('renametoix.py', '-revert-last'))
+
+    def test_crenametoix_imports(self):
+        self.check_imports(self.get_imports('crenametoix.py', '-test-mode',
+                                            '-find', 'a', '-replace', 'b', self.filename))
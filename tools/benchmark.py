@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import json
+import struct
+import shutil
+import zipfile
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+package_path = os.path.join(project_root, 'usr/lib/renametoix')
+sys.path.insert(0, package_path)
+sys.path.insert(0, os.path.join(package_path, 'plugins'))
+
+DEEP_FANOUT = 4
+# Relative change of a timing reported as a regression by -compare
+DEFAULT_TOLERANCE = 0.1
+
+
+def timed(callback, *params):
+    start = time.perf_counter()
+    result = callback(*params)
+    return round(time.perf_counter() - start, 4), result
+
+
+# ------------------------------------------------------------------------
+#                               hash
+# ------------------------------------------------------------------------
+
+def create_hash_corpus(path, count, size_mb):
+    block = os.urandom(1024 * 1024)
+    files = []
+    for index in range(count):
+        filename = os.path.join(path, f"file-{index:06d}.bin")
+        with open(filename, "wb") as f:
+            for _ in range(size_mb):
+                f.write(block)
+            # avoids identical files
+            f.write(index.to_bytes(8, "little"))
+        files.append(filename)
+    return files
+
+
+def bench_hash(path, count, size_mb, algorithms):
+    import hash as hash_plugin
+    files = create_hash_corpus(path, count, size_mb)
+    total_mb = count * size_mb
+    results = {"files": count, "total_mb": total_mb}
+    worker = hash_plugin.get_worker()
+    worker.set_macros([f"%{algorithm}%" for algorithm in algorithms])
+    results["prepare_s"], _ = timed(worker.prepare, files)
+    results["cached_prepare_s"], _ = timed(worker.prepare, files)
+    single_worker = hash_plugin.get_worker()
+    results["single_thread_s"], _ = timed(
+        lambda: [single_worker._hash_file(filename, algorithms) for filename in files])
+    for key in ["prepare_s", "single_thread_s"]:
+        results[key.replace("_s", "_mb_s")] = round(total_mb / max(results[key], 1e-9), 1)
+    return results
+
+
+# ------------------------------------------------------------------------
+#                               corpora
+# ------------------------------------------------------------------------
+
+def create_flat_corpus(path, count, depth):
+    files = []
+    for index in range(count):
+        filename = os.path.join(path, f"IMG_{index:07d}.jpg")
+        open(filename, "w").close()
+        files.append(filename)
+    return files
+
+
+def create_deep_corpus(path, count, depth):
+    # the files are distributed round-robin on the leaves of a tree with depth levels
+    leaves = [path]
+    for level in range(depth):
+        leaves = [os.path.join(parent, f"level{level}-{branch}")
+                  for parent in leaves for branch in range(DEEP_FANOUT)]
+    for leaf in leaves:
+        os.makedirs(leaf)
+    files = []
+    for index in range(count):
+        filename = os.path.join(leaves[index % len(leaves)], f"IMG_{index:07d}.jpg")
+        open(filename, "w").close()
+        files.append(filename)
+    return files
+
+
+def build_exif_jpeg(make, model, date):
+    # TIFF header, IFD0 with Make, Model and the EXIF IFD pointer, EXIF IFD with DateTimeOriginal
+    exif_ifd_offset = 8 + 2 + 3 * 12 + 4
+    data_offset = exif_ifd_offset + 2 + 12 + 4
+    data = bytearray()
+
+    def ascii_entry(tag, text):
+        value = text.encode("ascii") + b"\0"
+        # values up to 4 bytes are stored on the entry, instead of their offset
+        if len(value) <= 4:
+            return struct.pack("<HHI", tag, 2, len(value)) + value.ljust(4, b"\0")
+        entry = struct.pack("<HHII", tag, 2, len(value), data_offset + len(data))
+        data.extend(value)
+        return entry
+
+    ifd0 = struct.pack("<H", 3) + ascii_entry(0x010F, make) + ascii_entry(0x0110, model) \
+        + struct.pack("<HHII", 0x8769, 4, 1, exif_ifd_offset) + bytes(4)
+    exif_ifd = struct.pack("<H", 1) + ascii_entry(0x9003, date) + bytes(4)
+    tiff = b"II*\0" + struct.pack("<I", 8) + ifd0 + exif_ifd + bytes(data)
+    app1 = b"Exif\0\0" + tiff
+    return b"\xff\xd8\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xd9"
+
+
+def create_exif_corpus(path, count, depth):
+    start_date = datetime(2020, 1, 1)
+    files = []
+    for index in range(count):
+        filename = os.path.join(path, f"IMG_{index:07d}.jpg")
+        date = (start_date + timedelta(seconds=index)).strftime("%Y:%m:%d %H:%M:%S")
+        with open(filename, "wb") as f:
+            f.write(build_exif_jpeg("Canon", "EOS R5", date))
+        files.append(filename)
+    return files
+
+
+DOCX_PARTS = {
+    "[Content_Types].xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" '
+        'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '<Override PartName="/word/styles.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/></Types>',
+    "_rels/.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+        'relationships/officeDocument" Target="word/document.xml"/></Relationships>',
+    "word/_rels/document.xml.rels":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+        'relationships/styles" Target="styles.xml"/></Relationships>',
+    "word/styles.xml":
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        '<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/>'
+        '</w:style></w:styles>',
+}
+
+DOCX_DOCUMENT = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' \
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">' \
+    '<w:body><w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr><w:r><w:t>{header}</w:t></w:r>' \
+    '</w:p><w:p><w:r><w:t>Body text</w:t></w:r></w:p></w:body></w:document>'
+
+
+def create_docx_corpus(path, count, depth):
+    files = []
+    for index in range(count):
+        filename = os.path.join(path, f"doc-{index:07d}.docx")
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as docx:
+            for name, content in DOCX_PARTS.items():
+                docx.writestr(name, content)
+            docx.writestr("word/document.xml", DOCX_DOCUMENT.format(header=f"Report {index}"))
+        files.append(filename)
+    return files
+
+
+# corpus: (generator, is_reg_ex, find, replace)
+CORPORA = {
+    "flat": (create_flat_corpus, True, r"^IMG_(\d+)$", r"photo-\1-%Y%m%d-%000000n"),
+    "deep": (create_deep_corpus, True, r"^IMG_(\d+)$", r"photo-\1-%Y%m%d-%000000n"),
+    "exif": (create_exif_corpus, False, "", "%!{exif:%date:%Y%m%d_%H%M%S% %model%}-%000000n"),
+    "docx": (create_docx_corpus, False, "", "%!{doc:%header%}-%000000n")
+}
+
+
+# ------------------------------------------------------------------------
+#                               rename
+# ------------------------------------------------------------------------
+
+def bench_rename(path, corpus, count, depth):
+    import crenametoix
+    create_corpus, is_reg_ex, find, replace = CORPORA[corpus]
+    results = {"corpus": corpus, "files": count}
+    files = create_corpus(path, count, depth)
+    arg_parser = crenametoix.get_argument_parser()
+    crenametoix.add_arguments(arg_parser)
+    renamer = crenametoix.PureConsoleRename(arg_parser.parse_args(["-format", "null"]))
+
+    results["add_files_s"], _ = timed(renamer.add_files, files)
+    results["prepare_plugins_s"], _ = timed(
+        renamer.init_plugins, replace, lambda is_sync: None, True)
+    results["plugins_loaded"] = all(plugin.worker for plugin in renamer.plugins.values())
+    results["apply_macros_s"], _ = timed(
+        lambda: [renamer.apply_macros(replace, index, filename, [filename])
+                 for index, filename in enumerate(renamer.files)])
+    render_params = (1, is_reg_ex, False, find, replace)
+    results["generate_new_names_s"], _ = timed(renamer.generate_new_names, *render_params)
+    results["cached_generate_new_names_s"], _ = timed(
+        renamer.generate_new_names, *render_params)
+    results["renames"] = len(renamer.renames)
+    results["console_apply_renames_s"], _ = timed(renamer.console_apply_renames, False, True)
+    results["renamed"] = renamer.rename_count
+    return results
+
+
+# ------------------------------------------------------------------------
+#                               move
+# ------------------------------------------------------------------------
+
+def stream_move(src_file, dst_file, buffer_size):
+    # same loop as GioMover.copy_stream, the data goes through python buffers
+    with open(src_file, "rb") as src, open(dst_file, "wb") as dst:
+        while True:
+            data = src.read(buffer_size)
+            if not data:
+                break
+            dst.write(data)
+    shutil.copystat(src_file, dst_file)
+    os.unlink(src_file)
+
+
+def bench_move(path, dest, count, size_mb):
+    import crenametoix
+    if os.stat(path).st_dev == os.stat(dest).st_dev:
+        sys.exit("-dest must be on another file system than -path")
+    total_mb = count * size_mb
+    results = {"files": count, "total_mb": total_mb}
+    dest_path = tempfile.mkdtemp(prefix="renametoix-bench-", dir=dest)
+    try:
+        stream_path = os.path.join(path, "stream")
+        os.makedirs(stream_path)
+        files = create_hash_corpus(stream_path, count, size_mb)
+        results["stream_move_s"], _ = timed(
+            lambda: [stream_move(filename, os.path.join(dest_path, "stream-" + os.path.basename(
+                filename)), 1024 * 1024) for filename in files])
+
+        engine_path = os.path.join(path, "engine")
+        os.makedirs(engine_path)
+        files = create_hash_corpus(engine_path, count, size_mb)
+        arg_parser = crenametoix.get_argument_parser()
+        crenametoix.add_arguments(arg_parser)
+        renamer = crenametoix.PureConsoleRename(arg_parser.parse_args(["-format", "null"]))
+        renamer.add_files(files)
+        renamer.generate_new_names(1, True, True, "^", dest_path + "/")
+        results["move_s"], _ = timed(renamer.console_apply_renames, False, True)
+        results["renamed"] = renamer.rename_count
+    finally:
+        shutil.rmtree(dest_path, ignore_errors=True)
+    for key in ["stream_move_s", "move_s"]:
+        results[key.replace("_s", "_mb_s")] = round(total_mb / max(results[key], 1e-9), 1)
+    return results
+
+
+# ------------------------------------------------------------------------
+#                               baseline
+# ------------------------------------------------------------------------
+
+def get_environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_root,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+def compare_results(baseline, results, tolerance):
+    # timings ending in _s are lower is better, throughputs ending in _mb_s are higher is better
+    regressions = []
+    for key, value in results.items():
+        previous = baseline.get(key)
+        if not key.endswith("_s") or not isinstance(value, (int, float)) or not previous:
+            continue
+        change = (value - previous) / previous
+        is_regression = -change > tolerance if key.endswith("_mb_s") else change > tolerance
+        print(f"{key:32} {previous:>12} {value:>12} {change:+8.1%}"
+              f"{'  REGRESSION' if is_regression else ''}")
+        if is_regression:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("-path", help="Folder where the corpus is created (default: temporary)")
+    arg_parser.add_argument("-dest",
+                            help="Folder on another file system where move moves the files")
+    arg_parser.add_argument("-count", type=int, help="Number of files (default: 16 for hash and "
+                            "move, 10000 for the rename corpora)")
+    arg_parser.add_argument("-depth", type=int, default=4, help="Levels of the deep corpus tree")
+    arg_parser.add_argument("-size-mb", type=int, default=64, help="Size of each file")
+    arg_parser.add_argument("-algorithms", default="sha256")
+    arg_parser.add_argument("-output", help="Writes the results as JSON")
+    arg_parser.add_argument("-compare", metavar="BASELINE",
+                            help="Compares the results with a JSON written by -output")
+    arg_parser.add_argument("-tolerance", type=float, default=DEFAULT_TOLERANCE,
+                            help="Relative change reported as regression by -compare")
+    arg_parser.add_argument("action", choices=[
+        "hash", "move"
+    ] + list(CORPORA.keys()))
+    args = arg_parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix="renametoix-bench-", dir=args.path)
+    try:
+        if args.action == "hash":
+            results = bench_hash(work_path, args.count or 16, args.size_mb,
+                                 args.algorithms.split(","))
+        elif args.action == "move":
+            if not args.dest:
+                sys.exit("move requires -dest")
+            results = bench_move(work_path, args.dest, args.count or 16, args.size_mb)
+        else:
+            results = bench_rename(work_path, args.action, args.count or 10000, args.depth)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    results = {"action": args.action, **results, "environment": get_environment()}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("action") != args.action or baseline.get("files") != results.get("files"):
+            sys.exit("Baseline was created with another action or number of files")
+        sys.exit(1 if compare_results(baseline, results, args.tolerance) else 0)
+
+
+if __name__ == "__main__":
+    main()
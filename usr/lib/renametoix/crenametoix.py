@@ -8,24 +8,91 @@
 # ------------------------------------------------------------------------
 
 # cSpell:ignoreRegExp (hexpand|keyval|reorderable|renametoix|setproctitle|thunar|nemo|renamer)
+import io
 import os
+import errno
 import re
+import json
+import struct
 import argparse
 import sys
 import time
 import threading
-import importlib
+import importlib.util
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 
-sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), 'plugins'))
+PLUGINS_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'plugins')
+# Plugins installed by other packages declare an entry point on this group
+PLUGINS_ENTRY_POINTS_GROUP = "renametoix.plugins"
 
 STATE_ALREADY_EXISTS = -4
 STATE_EMPTY = -3
 STATE_NOT_CHANGED = -2
 STATE_RENAMED = -1
 
+# Placeholder for the sequential number while the rest of the macros are rendered
+INDEX_MARK = "\0"
+
+OUTPUT_FORMATS = ["text", "json", "jsonl", "tsv", "null"]
+OUTPUT_BUFFER_SIZE = 4096
+
+REGEX_ENGINES = ["re", "re2"]
+# Files whose regular expression takes longer are reported as slow, in seconds
+SLOW_REGEX_TIME = 0.1
+# Upper limits, in ms, of the plugins eval latency histogram buckets
+LATENCY_BUCKETS_MS = [0.01, 0.1, 1, 10, 100, 1000]
+
+PROFILE_MODES = ["cpu", "mem"]
+# Interval between the stack samples of the cpu profile, in seconds
+PROFILE_SAMPLE_INTERVAL = 0.001
+# Allocations with the largest growth reported for each phase of the mem profile
+PROFILE_TOP_ALLOCATIONS = 15
+
+# The names are rendered on a process pool only from this number of files
+PARALLEL_MIN_FILES = 2000
+PARALLEL_CHUNK_SIZE = 500
+
+PLAN_VERSION = 1
+
+# Suffix added to the new name by each -on-conflict policy, the hash policy adds a hash of
+# the source file path, and only uses the number if that name is also taken
+CONFLICT_POLICIES = {"skip": None, "suffix": "_%d", "number": " (%d)", "hash": "_%d"}
+CONFLICT_HASH_SIZE = 8
+
+# Moves between file systems are copied on parallel, in chunks of this size
+MOVE_MAX_JOBS = 4
+MOVE_CHUNK_SIZE = 64 * 1024 * 1024
+# ioctl that clones the file data, on file systems with reflinks (btrfs, xfs)
+FICLONE = 0x40049409
+
+# With -durable, the folders of the renamed files are synced once per batch of renames
+DURABLE_BATCH_SIZE = 1000
+
+# Folders kept open by DirFdCache, the least recently used are closed first
+DIR_FD_CACHE_SIZE = 256
+
+# Nested quantifiers, ex: (a+)+, are prone to catastrophic backtracking
+NESTED_QUANTIFIERS = re.compile(r"\((?:[^()\\]|\\.)*[+*}](?:[^()\\]|\\.)*\)[+*{]")
+
+STATE_CODES = {
+    STATE_ALREADY_EXISTS: "already-exists",
+    STATE_EMPTY: "empty",
+    STATE_NOT_CHANGED: "not-changed",
+    STATE_RENAMED: "renamed"
+}
+
 get_text_callback = None
 
 
+class RegexTimeout(Exception):
+    pass
+
+
+def raise_regex_timeout(signum, frame):
+    raise RegexTimeout(_("Regular expression timeout"))
+
+
 def _(text):
     return text if not get_text_callback else get_text_callback(text)
 
@@ -62,6 +129,8 @@ macros = {
 
     "%!{geo:%country%, %city%}": "Insert geographic metadata from plugin (country and city)",
     "%!{doc:%header%}": "Insert document metadata from plugin (header field)",
+    "%!{hash:%sha256:12%}": "Insert the first 12 digits of the file content SHA-256 hash",
+    "%!{exif:%date:%Y%m%d_%H%M%S%}": "Insert the photo capture date from the EXIF data",
 
     "%B": "Original filename without extension",
     "%E": "Original file extension (including dot, e.g., .txt)",
@@ -84,6 +153,35 @@ def add_arguments(arg_parser):
     arg_parser.add_argument("-test-mode", action='store_true', default=False,
                             help="%s (%s)" % (_("Outputs only the new result, doesn't rename"),
                                               console_mode_text))
+    arg_parser.add_argument("-format", choices=OUTPUT_FORMATS, default="text",
+                            help=_("Output format of the renames and files states"))
+    arg_parser.add_argument("-regex-engine", choices=REGEX_ENGINES, default="re",
+                            help=_("Regular expressions engine, re2 matches in linear time"))
+    arg_parser.add_argument("-regex-timeout", type=float, default=0, metavar="SECONDS",
+                            help=_("Maximum time of the regular expression on each file"))
+    arg_parser.add_argument("-on-conflict", choices=CONFLICT_POLICIES, default="skip",
+                            help=_("Skips the files with a name already taken, or adds a "
+                                   "suffix, a number or a hash to make it unique"))
+    arg_parser.add_argument("-save-plan", metavar="FILE",
+                            help=_("Writes the renames to a plan file, doesn't rename"))
+    arg_parser.add_argument("-apply-plan", metavar="FILE",
+                            help=_("Renames the files of a plan file, if they didn't change"))
+    arg_parser.add_argument("-durable", action='store_true', default=False,
+                            help=_("Syncs the folders of the renamed files to the disk, "
+                                   "once per folder on each batch of renames"))
+    arg_parser.add_argument("-jobs", type=int, default=1, metavar="N",
+                            help=_("Number of processes rendering the new names, 0 for all cpus"))
+    arg_parser.add_argument("-stats", action='store_true', default=False,
+                            help=_("Outputs the time of each phase and the counters to stderr"))
+    arg_parser.add_argument("-stats-file", metavar="FILE",
+                            help=_("Writes the time of each phase and the counters as JSON"))
+    arg_parser.add_argument("-trace-file", metavar="FILE",
+                            help=_("Writes the phases as Chrome trace events"))
+    arg_parser.add_argument("-profile", choices=PROFILE_MODES,
+                            help="%s (%s)" % (_("Profiles the cpu or the memory usage"),
+                                              console_mode_text))
+    arg_parser.add_argument("-profile-output", metavar="PREFIX", default="renametoix-profile",
+                            help=_("Prefix of the profile files"))
 
 
 def format_macros_help():
@@ -96,20 +194,188 @@ def format_macros_help():
 #                               Plugin
 # ------------------------------------------------------------------------
 
+def get_file_fingerprint(filename):
+    try:
+        file_stat = os.stat(filename)
+        return (file_stat.st_size, file_stat.st_mtime_ns)
+    except OSError:
+        return None
+
+
+def read_plugin_info(filename):
+    # PLUGIN_INFO is read from the source, so the metadata is available without importing
+    import ast
+    try:
+        with open(filename, "rb") as f:
+            tree = ast.parse(f.read(), filename)
+    except (OSError, SyntaxError, ValueError):
+        return {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name)
+                                                and target.id == "PLUGIN_INFO"
+                                                for target in node.targets):
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError:
+                return {}
+    return {}
+
+
+class PluginRegistry:
+    # Discovers the plugins once, on the plugins folder and on the entry points,
+    # the modules are only imported when a plugin is used, and the failures are kept
+    def __init__(self, plugins_path=PLUGINS_PATH):
+        self.plugins_path = plugins_path
+        self.infos = None
+        self.modules = {}
+        self.errors = {}
+
+    def discover(self):
+        if self.infos is not None:
+            return self.infos
+        self.infos = {}
+        if os.path.isdir(self.plugins_path):
+            for filename in sorted(os.listdir(self.plugins_path)):
+                plugin_name, ext = os.path.splitext(filename)
+                if ext == ".py" and not plugin_name.startswith("_"):
+                    full_filename = os.path.join(self.plugins_path, filename)
+                    self.infos[plugin_name] = {**read_plugin_info(full_filename),
+                                               "filename": full_filename}
+        for entry_point in self.get_entry_points():
+            if entry_point.name not in self.infos:
+                spec = None
+                try:
+                    spec = importlib.util.find_spec(entry_point.value.split(":")[0])
+                except (ImportError, ValueError):
+                    pass
+                info = read_plugin_info(spec.origin) if spec and spec.origin else {}
+                self.infos[entry_point.name] = {**info, "entry_point": entry_point}
+        return self.infos
+
+    def get_entry_points(self):
+        try:
+            from importlib import metadata
+            entry_points = metadata.entry_points()
+        except Exception:
+            return []
+        if hasattr(entry_points, "select"):
+            return entry_points.select(group=PLUGINS_ENTRY_POINTS_GROUP)
+        return entry_points.get(PLUGINS_ENTRY_POINTS_GROUP, [])
+
+    def get_info(self, plugin_name):
+        return self.discover().get(plugin_name)
+
+    def load_module(self, plugin_name):
+        if plugin_name in self.modules:
+            return self.modules[plugin_name]
+        if plugin_name in self.errors:
+            raise ImportError(self.errors[plugin_name])
+        info = self.get_info(plugin_name)
+        try:
+            if not info:
+                raise ImportError(_("Unknown plugin") + f" {plugin_name}")
+            if "entry_point" in info:
+                module = info["entry_point"].load()
+            else:
+                module_name = f"renametoix_plugin_{plugin_name}"
+                spec = importlib.util.spec_from_file_location(module_name, info["filename"])
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[module_name] = module
+                try:
+                    spec.loader.exec_module(module)
+                except BaseException:
+                    del sys.modules[module_name]
+                    raise
+        except Exception as e:
+            self.errors[plugin_name] = f"{plugin_name}: {e}"
+            raise ImportError(self.errors[plugin_name])
+        self.modules[plugin_name] = module
+        return module
+
+    def create_worker(self, plugin_name):
+        module = self.load_module(plugin_name)
+        # an entry point can refer the module or the get_worker function
+        return module() if callable(module) else module.get_worker()
+
+    def get_fields_description(self, text):
+        descriptions = []
+        for plugin_name in dict.fromkeys(re.findall(r"%!\{(\w+):", text)):
+            info = self.get_info(plugin_name) or {}
+            fields = info.get("fields")
+            if fields:
+                description = f"{plugin_name}: " + ", ".join(f"%{field}%" for field in fields)
+                if info.get("description"):
+                    description += " - " + info["description"]
+                descriptions.append(description)
+        return "\n".join(descriptions)
+
+
+plugin_registry = PluginRegistry()
+
+
 class Plugin:
-    def __init__(self, plugin_name):
+    def __init__(self, plugin_name, registry=None):
+        registry = registry or plugin_registry
         self.is_slow = False
+        self.new_files = []
+        self.prepared = {}
+        # files evaluated before being prepared, waiting for the next batch
+        self.queued_files = {}
+        # the GUI evaluates the macros while the batch is prepared on a thread
+        self.lock = threading.Lock()
+        self.error = None
         try:
-            self.worker = importlib.import_module(plugin_name).get_worker()
-            self.extensions = self.worker.get_extensions()
-        except:
+            self.worker = registry.create_worker(plugin_name)
+            # PLUGIN_INFO is used when declared, otherwise the worker is asked
+            info = registry.get_info(plugin_name) or {}
+            self.extensions = info["extensions"] if "extensions" in info \
+                else self.worker.get_extensions()
+            self.is_worker_slow = info["is_slow"] if "is_slow" in info \
+                else self.worker.is_slow()
+        except Exception as e:
             self.worker = None
+            self.error = str(e)
 
-    def set_new_files(self, new_files):
+    def set_new_files(self, files, changed_files=()):
         if self.worker:
-            self.new_files = self.filter_by_extension(new_files)
+            # files already prepared are skipped, the changed_files while they don't change
+            changed_files = set(changed_files)
+            with self.lock:
+                self.new_files = [
+                    filename for filename in self.filter_by_extension(files)
+                    if filename not in self.prepared
+                    or (filename in changed_files
+                        and self.prepared[filename] != get_file_fingerprint(filename))]
             if self.new_files:
-                self.is_slow = self.is_slow or self.worker.is_slow()
+                self.is_slow = self.is_slow or self.is_worker_slow
+
+    def prepare_file(self, filename):
+        with self.lock:
+            if self.filter_by_extension([filename]):
+                self.worker.prepare([filename])
+            self.prepared[filename] = get_file_fingerprint(filename)
+
+    def queue_file(self, filename):
+        with self.lock:
+            self.queued_files[filename] = True
+
+    def take_queued_files(self):
+        with self.lock:
+            files = list(self.queued_files)
+            self.queued_files.clear()
+        return files
+
+    def set_macros(self, macros):
+        # optional worker method, receives the plugin macros used on the replace text
+        if self.worker and hasattr(self.worker, "set_macros"):
+            self.worker.set_macros(macros)
+
+    def mark_prepared(self):
+        # files that can't be read are also marked, otherwise they would be queued forever
+        with self.lock:
+            for filename in self.new_files:
+                self.prepared[filename] = get_file_fingerprint(filename)
+            self.new_files = []
 
     def filter_by_extension(self, files):
         return list(
@@ -117,13 +383,114 @@ class Plugin:
                    in self.extensions, files)) if self.extensions and self.worker else files
 
 
+# ------------------------------------------------------------------------
+#                               DirFdCache
+# ------------------------------------------------------------------------
+
+class DirFdCache:
+    # each folder is opened once, and the files are checked, listed and renamed relative
+    # to the folder descriptor, so the kernel doesn't resolve the full path on every call
+    def __init__(self, stats, max_size=DIR_FD_CACHE_SIZE):
+        self.stats = stats
+        self.max_size = max_size
+        self.fds = OrderedDict()
+        # number of open folders inside each folder, including itself
+        self.open_inside = {}
+        # the descriptors are only used while holding the lock, so a descriptor closed
+        # by another thread is never used
+        self.lock = threading.Lock()
+        self.is_supported = {os.open, os.stat, os.rename} <= os.supports_dir_fd \
+            and os.listdir in os.supports_fd
+
+    def get_ancestors(self, dirname):
+        while True:
+            yield dirname
+            parent = os.path.dirname(dirname)
+            if parent == dirname:
+                break
+            dirname = parent
+
+    def get_fd(self, dirname):
+        fd = self.fds.get(dirname)
+        if fd is None:
+            self.stats.count("open_dir")
+            fd = self.fds[dirname] = os.open(dirname or ".", os.O_RDONLY | os.O_DIRECTORY)
+            for ancestor in self.get_ancestors(dirname):
+                self.open_inside[ancestor] = self.open_inside.get(ancestor, 0) + 1
+            if len(self.fds) > self.max_size:
+                self.close(next(iter(self.fds)))
+        else:
+            self.fds.move_to_end(dirname)
+        return fd
+
+    def close(self, dirname):
+        os.close(self.fds.pop(dirname))
+        for ancestor in self.get_ancestors(dirname):
+            count = self.open_inside.pop(ancestor) - 1
+            if count:
+                self.open_inside[ancestor] = count
+
+    def exists(self, filename):
+        dirname, basename = os.path.split(filename)
+        if not self.is_supported or not basename:
+            return os.path.exists(filename)
+        try:
+            with self.lock:
+                os.stat(basename, dir_fd=self.get_fd(dirname))
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def listdir(self, dirname):
+        if not self.is_supported:
+            return os.listdir(dirname)
+        with self.lock:
+            return os.listdir(self.get_fd(dirname))
+
+    def rename(self, src_file, dst_file):
+        src_dirname, src_basename = os.path.split(src_file)
+        dst_dirname, dst_basename = os.path.split(dst_file)
+        if not self.is_supported or not src_basename or not dst_basename:
+            return os.rename(src_file, dst_file)
+        with self.lock:
+            src_fd = self.get_fd(src_dirname)
+            os.rename(src_basename, dst_basename, src_dir_fd=src_fd,
+                      dst_dir_fd=self.get_fd(dst_dirname))
+            # the open folders inside a renamed folder are closed,
+            # otherwise their files would still be found on the old path
+            if src_file in self.open_inside:
+                prefix = src_file + os.sep
+                for dirname in [dirname for dirname in self.fds
+                                if dirname == src_file or dirname.startswith(prefix)]:
+                    self.close(dirname)
+
+    def fsync(self, dirname):
+        if not self.is_supported:
+            fd = os.open(dirname or ".", os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            return
+        with self.lock:
+            os.fsync(self.get_fd(dirname))
+
+    def clear(self):
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+            self.open_inside.clear()
+
+
 # ------------------------------------------------------------------------
 #                               G_File
 # ------------------------------------------------------------------------
 
 class G_File():
-    def __init__(self, filename):
+    def __init__(self, filename, dir_fds=None):
         self.filename = filename
+        self.dir_fds = dir_fds
 
     def get_basename(self):
         return os.path.basename(self.filename)
@@ -135,10 +502,11 @@ class G_File():
         return os.path.dirname(self.filename) != self.filename
 
     def get_parent(self):
-        return G_File(os.path.dirname(self.filename))
+        return G_File(os.path.dirname(self.filename), self.dir_fds)
 
     def query_exists(self):
-        return os.path.exists(self.filename)
+        return self.dir_fds.exists(self.filename) if self.dir_fds \
+            else os.path.exists(self.filename)
 
     def is_native(self):
         return True
@@ -150,14 +518,415 @@ class G_File():
 
 class G_FileBridge:
     def get_g_file(self, filename):
-        return G_File(filename)
+        return G_File(filename, self.dir_fds)
 
     def get_g_file_from_uri(self, uri):
+        if uri.startswith("file://"):
+            from urllib.parse import unquote
+            return self.get_g_file(unquote(uri[len("file://"):]))
         at = uri.find("://")
         return self.get_g_file(uri[at + 3:]) if at >= 0 else self.get_g_file(uri)
 
     def rename_file(self, g_source, g_dest, is_native):
-        os.rename(g_source.get_path(), g_dest.get_path())
+        move_file(g_source.get_path(), g_dest.get_path(), self.dir_fds)
+
+
+# ------------------------------------------------------------------------
+#                               Move
+# ------------------------------------------------------------------------
+
+def copy_file_data(src_fd, dst_fd, size):
+    # reflink clone, otherwise copy_file_range and sendfile copy inside the kernel
+    import fcntl
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return "clone"
+    except OSError:
+        pass
+    offset = 0
+    copy_function = getattr(os, "copy_file_range", None)
+    method = "copy_file_range"
+    while offset < size:
+        try:
+            if copy_function:
+                copied = copy_function(src_fd, dst_fd, min(MOVE_CHUNK_SIZE, size - offset))
+            else:
+                copied = os.sendfile(dst_fd, src_fd, offset, min(MOVE_CHUNK_SIZE, size - offset))
+        except OSError as e:
+            # copy_file_range isn't supported between some file systems
+            if not copy_function or e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                                    errno.EOPNOTSUPP]:
+                raise
+            copy_function = None
+            method = "sendfile"
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            continue
+        if not copied:
+            break
+        offset += copied
+    return method
+
+
+def move_file(src_file, dst_file, dir_fds=None):
+    try:
+        if dir_fds:
+            dir_fds.rename(src_file, dst_file)
+        else:
+            os.rename(src_file, dst_file)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    import shutil
+    src_stat = os.lstat(src_file)
+    if not os.path.isfile(src_file) or os.path.islink(src_file):
+        shutil.move(src_file, dst_file)
+        return "move"
+    src_fd = os.open(src_file, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         src_stat.st_mode & 0o7777)
+        try:
+            method = copy_file_data(src_fd, dst_fd, src_stat.st_size)
+            shutil.copystat(src_file, dst_file)
+            os.fsync(dst_fd)
+        except BaseException:
+            os.close(dst_fd)
+            os.unlink(dst_file)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    # the source is only deleted after the copy is on the disk
+    dir_fd = os.open(os.path.dirname(os.path.abspath(dst_file)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    os.unlink(src_file)
+    return method
+
+
+# ------------------------------------------------------------------------
+#                               OutputWriter
+# ------------------------------------------------------------------------
+
+class OutputWriter:
+    def __init__(self, output_format="text", stream=None):
+        self.output_format = output_format
+        self.stream = stream or sys.stdout
+        self.lines = []
+        self.records = []
+
+    def write_record(self, record):
+        if self.output_format == "text":
+            if record["state"] == STATE_CODES[STATE_RENAMED]:
+                self.write_line(f"{record['file']} -> {os.path.basename(record['new_file'])}")
+            else:
+                self.write_line(f"{record['file']}: {record['description']}")
+        elif self.output_format == "jsonl":
+            self.write_line(json.dumps(record, ensure_ascii=False))
+        elif self.output_format == "tsv":
+            self.write_line("\t".join(self.escape_tsv(record[key] or "") for key in
+                                      ["state", "file", "new_file", "description"]))
+        elif self.output_format == "json":
+            self.records.append(record)
+
+    def write_summary(self, rename_count):
+        if self.output_format == "text" and rename_count:
+            self.write_line(_('%d files renamed') % rename_count)
+
+    def write_line(self, line):
+        self.lines.append(line + "\n")
+        if len(self.lines) >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def escape_tsv(self, text):
+        return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+    def flush(self):
+        if self.lines:
+            self.stream.write("".join(self.lines))
+            self.lines.clear()
+        self.stream.flush()
+
+    def close(self, rename_count=0):
+        if self.output_format == "json":
+            json.dump({"renamed": rename_count, "files": self.records}, self.stream,
+                      ensure_ascii=False)
+            self.stream.write("\n")
+            self.records = []
+        self.flush()
+
+
+# ------------------------------------------------------------------------
+#                               Stats
+# ------------------------------------------------------------------------
+
+class NullStats:
+    # Used when the stats are disabled, every hook is a no-op
+    enabled = False
+
+    def phase(self, name, trace=True):
+        return nullcontext()
+
+    def plugin_prepare(self, plugin_name, files_count):
+        return nullcontext()
+
+    def plugin_eval(self, plugin_name):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+    def create_child(self):
+        return self
+
+    def merge(self, stats):
+        pass
+
+    def write(self, args):
+        pass
+
+
+class Stats(NullStats):
+    enabled = True
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # optional, called with the name at the end of each traced phase
+        self.phase_callback = None
+        self.phases = {}
+        self.counters = {}
+        self.plugins = {}
+        self.trace_events = []
+
+    @contextmanager
+    def phase(self, name, trace=True):
+        # phases that run once per file aren't traced, only their total time is kept
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+            if trace:
+                self.trace_events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "ts": round((start - self.start) * 1e6, 1), "dur": round(elapsed * 1e6, 1)
+                })
+                if self.phase_callback:
+                    self.phase_callback(name)
+
+    def get_plugin_stats(self, plugin_name):
+        plugin_stats = self.plugins.get(plugin_name)
+        if plugin_stats is None:
+            plugin_stats = self.plugins[plugin_name] = {
+                "prepare_s": 0, "prepared_files": 0, "eval_count": 0, "eval_s": 0,
+                "eval_histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            }
+        return plugin_stats
+
+    @contextmanager
+    def plugin_prepare(self, plugin_name, files_count):
+        start = time.perf_counter()
+        try:
+            with self.phase(f"prepare:{plugin_name}"):
+                yield
+        finally:
+            plugin_stats = self.get_plugin_stats(plugin_name)
+            plugin_stats["prepare_s"] += time.perf_counter() - start
+            plugin_stats["prepared_files"] += files_count
+
+    @contextmanager
+    def plugin_eval(self, plugin_name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            plugin_stats = self.get_plugin_stats(plugin_name)
+            plugin_stats["eval_count"] += 1
+            plugin_stats["eval_s"] += elapsed
+            bucket = 0
+            while bucket < len(LATENCY_BUCKETS_MS) and elapsed * 1000 > LATENCY_BUCKETS_MS[bucket]:
+                bucket += 1
+            plugin_stats["eval_histogram"][bucket] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def create_child(self):
+        # stats of a worker process, sent back to the parent and added with merge
+        stats = Stats()
+        stats.start = self.start
+        return stats
+
+    def merge(self, stats):
+        for name, elapsed in stats.phases.items():
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+        for name, value in stats.counters.items():
+            self.count(name, value)
+        for plugin_name, child_plugin_stats in stats.plugins.items():
+            plugin_stats = self.get_plugin_stats(plugin_name)
+            for key, value in child_plugin_stats.items():
+                plugin_stats[key] = [total + count for total, count in
+                                     zip(plugin_stats[key], value)] \
+                    if key == "eval_histogram" else plugin_stats[key] + value
+        self.trace_events.extend(stats.trace_events)
+
+    def get_histogram_labels(self):
+        return [f"<={limit}ms" for limit in LATENCY_BUCKETS_MS] \
+            + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+
+    def to_dict(self):
+        labels = self.get_histogram_labels()
+        return {
+            "total_s": round(time.perf_counter() - self.start, 6),
+            "phases": {name: round(elapsed, 6) for name, elapsed in self.phases.items()},
+            "counters": self.counters,
+            "plugins": {plugin_name: {
+                **{key: round(value, 6) if isinstance(value, float) else value
+                   for key, value in plugin_stats.items() if key != "eval_histogram"},
+                "eval_histogram": dict(zip(labels, plugin_stats["eval_histogram"]))
+            } for plugin_name, plugin_stats in self.plugins.items()}
+        }
+
+    def write(self, args):
+        stats = self.to_dict()
+        if getattr(args, "stats_file", None):
+            with open(args.stats_file, "w") as f:
+                json.dump(stats, f, indent=2)
+        if getattr(args, "trace_file", None):
+            with open(args.trace_file, "w") as f:
+                json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+        if getattr(args, "stats", False):
+            lines = [_("Phases") + ":"]
+            lines += [f"  {name:28} {elapsed:10.4f}s" for name, elapsed in stats["phases"].items()]
+            lines += [f"  {_('Total'):28} {stats['total_s']:10.4f}s", _("Counters") + ":"]
+            lines += [f"  {name:28} {value:10}" for name, value in stats["counters"].items()]
+            for plugin_name, plugin_stats in stats["plugins"].items():
+                lines.append(_("Plugin") + f" {plugin_name}:")
+                lines += [f"  {key:28} {value:10}" for key, value in plugin_stats.items()
+                          if key != "eval_histogram"]
+                lines.append("  " + " ".join(f"{label}: {count}" for label, count
+                                             in plugin_stats["eval_histogram"].items()))
+            sys.stderr.write("\n".join(lines) + "\n")
+
+
+def create_stats(args):
+    return Stats() if getattr(args, "stats", False) or getattr(args, "stats_file", None) \
+        or getattr(args, "trace_file", None) or getattr(args, "profile", None) == "mem" \
+        else NullStats()
+
+
+# ------------------------------------------------------------------------
+#                               Profile
+# ------------------------------------------------------------------------
+
+class StackSampler(threading.Thread):
+    # Samples the stack of a thread, the counts are written as collapsed stacks for flame graphs
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = {}
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                             f":{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def write_memory_report(filename, snapshots):
+    import tracemalloc
+    with open(filename, "w") as f:
+        previous = None
+        for phase_name, snapshot, (current, peak) in snapshots:
+            snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            f.write(f"{phase_name}: current {current / 1024:.1f} KiB, "
+                    f"peak {peak / 1024:.1f} KiB\n")
+            statistics = snapshot.compare_to(previous, "lineno") if previous \
+                else snapshot.statistics("lineno")
+            for stat in statistics[:PROFILE_TOP_ALLOCATIONS]:
+                size = getattr(stat, "size_diff", stat.size)
+                count = getattr(stat, "count_diff", stat.count)
+                f.write(f"  {size / 1024:+10.1f} KiB {count:+8} blocks  {stat.traceback[0]}\n")
+            previous = snapshot
+
+
+def profile_console_rename(renamer):
+    # Runs the console mode rename with the cpu or memory profile selected by -profile
+    args = renamer.args
+    mode = getattr(args, "profile", None)
+    if not mode:
+        return renamer.console_mode_rename()
+    prefix = args.profile_output
+    if mode == "cpu":
+        import cProfile
+        profiler = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        profiler.enable()
+        try:
+            renamer.console_mode_rename()
+        finally:
+            profiler.disable()
+            sampler.stop()
+            profiler.dump_stats(prefix + ".pstats")
+            sampler.write(prefix + ".collapsed")
+            sys.stderr.write(_("Profile written to") + f" {prefix}.pstats {prefix}.collapsed\n")
+    else:
+        import tracemalloc
+        snapshots = []
+        tracemalloc.start()
+        renamer.stats.phase_callback = lambda name: snapshots.append(
+            (name, tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()))
+        try:
+            renamer.console_mode_rename()
+        finally:
+            tracemalloc.stop()
+            write_memory_report(prefix + ".mem.txt", snapshots)
+            sys.stderr.write(_("Profile written to") + f" {prefix}.mem.txt\n")
+
+
+# ------------------------------------------------------------------------
+#                               Parallel rendering
+# ------------------------------------------------------------------------
+
+# The process pool is forked, so the workers inherit the renamer with its prepared plugins,
+# the files prepared by a worker on their first evaluation are prepared again by the parent
+# if it evaluates them, since the plugins data of the workers isn't sent back
+prerender_renamer = None
+
+
+def prerender_chunk(render_key, filenames):
+    # each chunk counts on new stats and slow regex files, returned with the names to be
+    # merged by the parent, which reports them
+    stats = prerender_renamer.stats = prerender_renamer.stats.create_child()
+    slow_regex_files = prerender_renamer.slow_regex_files = []
+    with stats.phase("render_file_name", False):
+        rendered = [prerender_renamer.render_file_name(filename, *render_key)
+                    for filename in filenames]
+    return rendered, stats, slow_regex_files
 
 
 # ------------------------------------------------------------------------
@@ -176,9 +945,29 @@ class PureConsoleRename(G_FileBridge):
         self.allow_renames = False
         self.plugins = {}
         self.prepared_files_count = 0
+        # with True, the files not prepared are queued for the next init_plugins,
+        # instead of being prepared when they are evaluated
+        self.queue_lazy_prepares = False
         self.thread_running = False
         self.demon = None
         self.exception = None
+        self.render_key = None
+        self.render_pipeline = []
+        self.render_cache = {}
+        # fingerprint of the files whose render evaluated macros, like the mtime
+        self.render_fingerprints = {}
+        self.exists_cache = {}
+        self.folder_names_cache = {}
+        self.devices_cache = {}
+        self.find_patterns = {}
+        self.pipeline = []
+        self.slow_regex_files = []
+        self.next_index = None
+        self.output = OutputWriter(getattr(args, "format", "text"))
+        self.stats = create_stats(args)
+        self.dir_fds = DirFdCache(self.stats)
+        self.durable_folders = set()
+        self.durable_count = 0
 
     def macro_functions(self, group_nr, macro_name, groups):
         if len(groups) <= group_nr:
@@ -193,13 +982,14 @@ class PureConsoleRename(G_FileBridge):
         except:
             return groups(0)
 
-    def apply_macros(self, text, start_index, filename, groups):
-        text = re.sub(r"%(\d*)n", lambda m: "%0*d" % (len(m.group(1)) + 1, start_index), text)
+    def render_macros(self, text, filename, groups):
+        text = re.sub(r"%(\d*)n", lambda m: f"{INDEX_MARK}{len(m.group(1)) + 1}{INDEX_MARK}", text)
         text = re.sub(r"%(\d)\{([a-z]+)\}", lambda m: self.macro_functions(
             int(m.group(1)), m.group(2), groups), text)
         text = re.sub(r"%:\{([^}]+)\}", lambda m: self.run_python_expr(m.group(1), groups), text)
         text = re.sub(r"%!\{(\w+):([^}]+)\}", lambda m:
                       self.run_plugin_expr(m.group(1), m.group(2), filename, groups), text)
+        self.stats.count("stat")
         stamp_parts = time.strftime("%Y_%m_%d_%H_%M_%S",
                                     time.localtime(os.path.getmtime(filename))).split("_")
         for index, macro_name in enumerate("YmdHMS"):
@@ -208,45 +998,278 @@ class PureConsoleRename(G_FileBridge):
         text = text.replace("%B", basename).replace("%E", ext)
         return text
 
+    def apply_index(self, text, start_index):
+        if INDEX_MARK not in text:
+            return text
+        return re.sub(f"{INDEX_MARK}(\\d+){INDEX_MARK}",
+                      lambda m: "%0*d" % (int(m.group(1)), start_index), text)
+
+    def apply_macros(self, text, start_index, filename, groups):
+        return self.apply_index(self.render_macros(text, filename, groups), start_index)
+
     def set_file_index_new_name(self, index, new_name=None):
         self.files_list_store[index][3] = new_name if new_name is not None \
             else self.files_list_store[index][2]
 
+    def render_file_name(self, filename, is_reg_ex, include_ext, find, replace):
+        # Everything that doesn't depend on the file position is computed here,
+        # so the result can be reused when only the order or the selection changes
+        g_file = self.get_g_file(filename)
+        basename = g_file.get_basename()
+        dirname = g_file.get_parent().get_path() if g_file.has_parent() else ""
+        new_text, ext = os.path.splitext(basename) \
+            if not include_ext else (basename, None)
+        uses_index = False
+        # the pipeline steps run in a single pass, each step transforms the previous result
+        for step_is_reg_ex, step_find, step_replace in self.get_steps(is_reg_ex, find, replace):
+            try:
+                new_text, step_uses_index = self.render_step(
+                    filename, new_text, step_is_reg_ex, step_find, step_replace)
+            except re.error:
+                raise
+            except Exception as e:
+                return [basename, dirname, None, ext, False,
+                        str(e.args[0]) if len(e.args) > 0 else ""]
+            uses_index = uses_index or step_uses_index
+        return [basename, dirname, new_text, ext, uses_index, None]
+
+    def render_step(self, filename, from_text, is_reg_ex, find, replace):
+        find_text = find or (from_text if not is_reg_ex else "^(.*)$")
+        matches = None
+        if is_reg_ex:
+            pattern = self.compile_find(find_text)
+            with self.regex_budget(filename):
+                new_text = pattern.sub(replace, from_text)
+                if new_text and re.search(r"%[0-9A-Za-z:!]", new_text):
+                    matches = pattern.search(from_text)
+        else:
+            new_text = from_text.replace(find_text, replace)
+
+        if new_text and re.search(r"%[0-9A-Za-z:!]", new_text):
+            groups = [find_text]
+            if matches:
+                groups = [matches.group(0)] + list(matches.groups())
+            return self.render_macros(new_text, filename, groups), True
+        return new_text, False
+
+    def set_pipeline(self, steps):
+        # steps are dictionaries with find, replace and reg-ex, as stored on the config
+        self.pipeline = [[bool(step.get("reg-ex", False)), str(step.get("find") or ""),
+                          str(step.get("replace") or "")] for step in steps]
+
+    def get_steps(self, is_reg_ex, find, replace):
+        # find and replace run after the pipeline steps
+        return self.pipeline + ([[is_reg_ex, find, replace]]
+                                if find != "" or replace != "" or not self.pipeline else [])
+
+    def get_replace_texts(self):
+        return "\n".join([step[2] for step in self.pipeline] + [self.args.replace])
+
+    def compile_find(self, find_text):
+        pattern = self.find_patterns.get(find_text)
+        if pattern is None:
+            if getattr(self.args, "regex_engine", "re") == "re2":
+                try:
+                    import re2
+                except ImportError:
+                    raise Exception(_("re2 regular expressions engine isn't installed"))
+                # re2 character classes, like \w, are ASCII only as with re.A
+                pattern = re2.compile(find_text)
+            else:
+                pattern = re.compile(find_text, flags=re.A)
+            self.find_patterns[find_text] = pattern
+        return pattern
+
+    @contextmanager
+    def regex_budget(self, filename):
+        # SIGALRM interrupts the re matching loop, it's only available on the main thread
+        import signal
+        timeout = getattr(self.args, "regex_timeout", 0)
+        use_timer = timeout and hasattr(signal, "setitimer") \
+            and threading.current_thread() is threading.main_thread()
+        if use_timer:
+            previous_handler = signal.signal(signal.SIGALRM, raise_regex_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if use_timer:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
+            elapsed = time.perf_counter() - start
+            if elapsed >= SLOW_REGEX_TIME:
+                self.slow_regex_files.append((filename, elapsed))
+
+    def report_regex_diagnostics(self, is_reg_ex, find):
+        if not is_reg_ex:
+            return
+        if getattr(self.args, "regex_engine", "re") == "re" \
+                and not getattr(self.args, "regex_timeout", 0) and NESTED_QUANTIFIERS.search(find):
+            self.write_error(_("Warning") + ": " + _(
+                "Regular expression with nested quantifiers can be very slow, "
+                "use -regex-engine re2 or -regex-timeout"))
+        if self.slow_regex_files:
+            filename, elapsed = max(self.slow_regex_files, key=lambda item: item[1])
+            self.write_error(_("Warning") + ": " + _("Slow regular expression on %d files") % len(
+                self.slow_regex_files) + f", {filename}: {elapsed:.2f}s")
+
+    def prerender_file_names(self, render_key):
+        # only the rendering runs on the process pool, the %n numbers and the conflicts
+        # are assigned afterwards by generate_new_names in the files order
+        global prerender_renamer
+        jobs = getattr(self.args, "jobs", 1)
+        jobs = jobs if jobs > 0 else os.cpu_count() or 1
+        if jobs <= 1 or len(self.files) < PARALLEL_MIN_FILES:
+            return
+        filenames = [filename for index, filename in enumerate(self.files)
+                     if self.files_list_store[index][0] and filename not in self.render_cache]
+        import multiprocessing
+        if len(filenames) < PARALLEL_MIN_FILES \
+                or "fork" not in multiprocessing.get_all_start_methods():
+            return
+        chunks = [filenames[pos:pos + PARALLEL_CHUNK_SIZE]
+                  for pos in range(0, len(filenames), PARALLEL_CHUNK_SIZE)]
+        prerender_renamer = self
+        try:
+            with self.stats.phase("prerender_file_names"), \
+                    multiprocessing.get_context("fork").Pool(min(jobs, len(chunks))) as pool:
+                for chunk, (rendered, stats, slow_regex_files) in zip(chunks, pool.starmap(
+                        prerender_chunk, [(render_key, chunk) for chunk in chunks])):
+                    for filename, file_rendered in zip(chunk, rendered):
+                        self.cache_render(filename, file_rendered)
+                    self.stats.merge(stats)
+                    self.slow_regex_files.extend(slow_regex_files)
+        finally:
+            prerender_renamer = None
+
+    def cache_render(self, filename, rendered):
+        self.render_cache[filename] = rendered
+        if rendered[4]:
+            self.render_fingerprints[filename] = get_file_fingerprint(filename)
+        else:
+            self.render_fingerprints.pop(filename, None)
+        return rendered
+
+    def get_rendered_file_name(self, filename, render_key):
+        rendered = self.render_cache.get(filename)
+        # the renders with macros are reused only while the file is unchanged
+        if rendered is not None and filename in self.render_fingerprints:
+            self.stats.count("stat")
+            if self.render_fingerprints[filename] != get_file_fingerprint(filename):
+                rendered = None
+        if rendered is None:
+            self.stats.count("render_cache_misses")
+            with self.stats.phase("render_file_name", False):
+                rendered = self.cache_render(filename,
+                                             self.render_file_name(filename, *render_key))
+        else:
+            self.stats.count("render_cache_hits")
+        return rendered
+
+    def new_file_exists(self, filename):
+        exists = self.exists_cache.get(filename)
+        if exists is None:
+            self.stats.count("stat")
+            with self.stats.phase("conflict_checks", False):
+                exists = self.exists_cache[filename] = self.get_g_file(filename).query_exists()
+        else:
+            self.stats.count("exists_cache_hits")
+        return exists
+
+    def clear_caches(self, filenames=None):
+        if filenames is None:
+            self.render_cache.clear()
+            self.render_fingerprints.clear()
+            self.exists_cache.clear()
+            self.folder_names_cache.clear()
+            self.dir_fds.clear()
+        else:
+            for filename in filenames:
+                self.render_cache.pop(filename, None)
+                self.render_fingerprints.pop(filename, None)
+
+    def get_folder_names(self, dirname):
+        # the folder is listed once, afterwards the names are checked without system calls
+        names = self.folder_names_cache.get(dirname)
+        if names is None:
+            try:
+                self.stats.count("listdir")
+                names = set(self.dir_fds.listdir(dirname))
+            except OSError:
+                names = False
+            self.folder_names_cache[dirname] = names
+        return names
+
+    def resolve_conflict(self, filename, new_filename, new_filenames, counters):
+        # the candidates are checked on the folder names and on the planned names, and
+        # the counter of each name continues from the last candidate, keeping it linear
+        policy = getattr(self.args, "on_conflict", "skip")
+        dirname, new_basename = os.path.split(new_filename)
+        base, ext = os.path.splitext(new_basename)
+        folder_names = self.get_folder_names(dirname)
+        number = counters.get(new_filename, 0)
+        if policy == "hash":
+            import hashlib
+            base += "_" + hashlib.sha1(os.fsencode(filename)).hexdigest()[:CONFLICT_HASH_SIZE]
+            number = 0
+        elif not number:
+            number = 1
+        while True:
+            candidate = base + (CONFLICT_POLICIES[policy] % number if number else "") + ext
+            candidate_filename = os.path.join(dirname, candidate)
+            if candidate_filename not in new_filenames:
+                if folder_names is False:
+                    if not self.new_file_exists(candidate_filename):
+                        break
+                elif candidate not in folder_names:
+                    self.exists_cache[candidate_filename] = False
+                    break
+            number += 1
+        if policy != "hash":
+            counters[new_filename] = number + 1
+        return candidate_filename
+
     def generate_new_names(self, start_index, is_reg_ex, include_ext, find, replace):
         new_filenames = {}
+        conflict_counters = {}
+        resolves_conflicts = getattr(self.args, "on_conflict", "skip") != "skip"
         self.renames.clear()
+        # the files can be created or removed outside between passes
+        self.exists_cache.clear()
+        self.folder_names_cache.clear()
         for index, filename in enumerate(self.files):
             self.set_file_index_new_name(index)
             self.files_state[index] = STATE_NOT_CHANGED
-        self.allow_renames = find != "" or replace != ""
+        self.allow_renames = find != "" or replace != "" or len(self.pipeline) > 0
         if not self.allow_renames:
             return
 
+        render_key = (is_reg_ex, include_ext, find, replace)
+        if render_key != self.render_key or self.pipeline != self.render_pipeline:
+            self.render_cache.clear()
+            self.render_fingerprints.clear()
+            self.render_key = render_key
+            self.render_pipeline = [list(step) for step in self.pipeline]
+
+        self.slow_regex_files.clear()
         try:
+            # validates the patterns once, before any file
+            for step_is_reg_ex, step_find, _step_replace in self.get_steps(is_reg_ex, find,
+                                                                           replace):
+                if step_is_reg_ex:
+                    self.compile_find(step_find or "^(.*)$")
+            self.prerender_file_names(render_key)
             for index, filename in enumerate(self.files):
                 if not self.files_list_store[index][0]:
                     continue
-                g_file = self.get_g_file(filename)
-                basename = g_file.get_basename()
-                dirname = g_file.get_parent().get_path() if g_file.has_parent() else ""
-                from_text, ext = os.path.splitext(basename) \
-                    if not include_ext else (basename, None)
-                find_text = find or (from_text if not is_reg_ex else "^(.*)$")
-                new_text = re.sub(find_text, replace, from_text, flags=re.A) if is_reg_ex \
-                    else from_text.replace(find_text, replace)
-
-                if new_text and re.search(r"%[0-9A-Za-z:!]", new_text):
-                    groups = [find_text]
-                    if is_reg_ex:
-                        matches = re.search(find_text, from_text, flags=re.A)
-                        if matches:
-                            groups = [matches.group(0)] + list(matches.groups())
-                    try:
-                        new_text = self.apply_macros(new_text, start_index, filename, groups)
-                    except Exception as e:
-                        self.set_file_index_new_name(index)
-                        self.files_state[index] = str(e.args[0]) if len(e.args) > 0 else ""
-                        continue
+                basename, dirname, new_text, ext, uses_index, error = \
+                    self.get_rendered_file_name(filename, render_key)
+                if error is not None:
+                    self.files_state[index] = error
+                    continue
+                if uses_index:
+                    new_text = self.apply_index(new_text, start_index)
                     start_index += 1
 
                 new_basename = (new_text + ext) if not include_ext else new_text
@@ -254,7 +1277,13 @@ class PureConsoleRename(G_FileBridge):
                 self.set_file_index_new_name(index, new_basename)
                 if basename != new_basename:
                     if new_basename:
-                        if not self.get_g_file(new_filename).query_exists():
+                        if resolves_conflicts and (new_filename in new_filenames
+                                                   or self.new_file_exists(new_filename)):
+                            new_filename = self.resolve_conflict(filename, new_filename,
+                                                                 new_filenames, conflict_counters)
+                            new_basename = os.path.basename(new_filename)
+                            self.set_file_index_new_name(index, new_basename)
+                        if not self.new_file_exists(new_filename):
                             conflict_index = new_filenames.get(new_filename)
                             if conflict_index is None:
                                 new_filenames[new_filename] = index
@@ -268,22 +1297,43 @@ class PureConsoleRename(G_FileBridge):
                         self.files_state[index] = STATE_EMPTY
 
             self.allow_renames = len(self.renames) > 0
+            self.next_index = start_index
         except Exception as e:
             self.exception = e
             self.allow_renames = False
 
     def get_state_description(self, state):
-        return state if type(state) is str else {
+        if type(state) is str:
+            return state
+        if state not in STATE_CODES:
+            return _("Conflicts with file") + (": %s" % self.files_list_store[state][2])
+        return {
             STATE_ALREADY_EXISTS: _("Already exists"),
             STATE_EMPTY: _("Empty"),
             STATE_NOT_CHANGED: _("Not changed"),
             STATE_RENAMED: _("Renamed")
-        }.get(state, _("Conflicts with file") + (": %s" % self.files_list_store[state][2]))
+        }[state]
+
+    def get_state_code(self, state):
+        return "error" if type(state) is str else STATE_CODES.get(state, "conflict")
+
+    def get_file_record(self, filename, new_filename, state, applied=False):
+        record = {
+            "file": filename,
+            "new_file": new_filename,
+            "state": self.get_state_code(state),
+            "description": self.get_state_description(state),
+            "applied": applied
+        }
+        if self.get_state_code(state) == "conflict":
+            record["conflicts_with"] = self.files[state]
+        return record
 
     def add_files(self, uris):
         for uri in uris:
             g_file = self.get_g_file_from_uri(uri)
             filename = g_file.get_path()
+            self.stats.count("stat")
             if g_file.query_exists() and filename not in self.files:
                 basename = g_file.get_basename()
                 self.files_list_store.append(
@@ -304,58 +1354,210 @@ class PureConsoleRename(G_FileBridge):
         # to override
         pass
 
+    def sync_journal(self):
+        # to override, syncs to the disk the renames journal before the folders are synced
+        pass
+
+    def add_durable_rename(self, src_file, dst_file, is_native):
+        # a rename is only on the disk after both folders are synced, the folders
+        # are synced once per batch, instead of once per file
+        if not getattr(self.args, "durable", False) or not is_native:
+            return
+        self.durable_folders.add(os.path.dirname(src_file))
+        self.durable_folders.add(os.path.dirname(dst_file))
+        self.durable_count += 1
+        if self.durable_count >= DURABLE_BATCH_SIZE:
+            self.commit_durable_renames()
+
+    def commit_durable_renames(self):
+        if not self.durable_count:
+            return
+        with self.stats.phase("durable_sync", False):
+            self.sync_journal()
+            for dirname in sorted(self.durable_folders):
+                self.stats.count("fsync")
+                self.dir_fds.fsync(dirname)
+        self.durable_folders.clear()
+        self.durable_count = 0
+
     def wait_until(self, callback):
         self.demon.join()
         callback()
 
+    def get_device(self, dirname):
+        device = self.devices_cache.get(dirname)
+        if device is None:
+            self.stats.count("stat")
+            device = self.devices_cache[dirname] = os.stat(dirname).st_dev
+        return device
+
+    def defer_rename(self, g_source, g_dest, is_native):
+        # returns True if the rename is executed by apply_deferred_renames,
+        # moves between file systems are copies, they are executed in parallel
+        if not is_native:
+            return False
+        try:
+            return self.get_device(os.path.dirname(os.path.abspath(g_source.get_path()))) \
+                != self.get_device(os.path.dirname(os.path.abspath(g_dest.get_path())))
+        except OSError:
+            return False
+
+    def apply_deferred_renames(self, renames, is_silent):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=MOVE_MAX_JOBS) as executor:
+            futures = [executor.submit(self.rename_file, g_source, g_dest, is_native)
+                       for _src_file, _dst_file, g_source, g_dest, is_native in renames]
+            for (src_file, dst_file, g_source, g_dest, is_native), future in zip(renames,
+                                                                                 futures):
+                try:
+                    future.result()
+                except OSError as e:
+                    self.report_rename(src_file, None, is_silent, False,
+                                       _("Error during rename operation") + f": {e}")
+                    continue
+                self.after_rename(src_file, dst_file, is_native)
+                self.add_durable_rename(src_file, dst_file, is_native)
+                self.rename_count += 1
+                self.report_rename(src_file, dst_file, is_silent)
+
+    def report_rename(self, src_file, dst_file, is_silent, applied=True, state=STATE_RENAMED):
+        if not is_silent:
+            self.output.write_record(self.get_file_record(src_file, dst_file, state, applied))
+
     def console_apply_renames(self, test_mode=False, is_silent=False):
         if self.allow_renames:
-            for rename in self.renames:
-                src_file, dst_file = rename
-                g_source = self.get_g_file(src_file)
-                g_dest = self.get_g_file(dst_file)
-                is_native = g_source.is_native()
-                if not g_dest.query_exists():
-                    if not test_mode:
-                        self.rename_file(g_source, g_dest, is_native)
-                        self.after_rename(src_file, dst_file, is_native)
-                        self.rename_count += 1
-                    if not is_silent:
-                        print(f"{src_file} -> {self.get_g_file(dst_file).get_basename()}")
+            deferred_renames = []
+            try:
+                for rename in self.renames:
+                    src_file, dst_file = rename
+                    g_source = self.get_g_file(src_file)
+                    g_dest = self.get_g_file(dst_file)
+                    is_native = g_source.is_native()
+                    self.stats.count("stat")
+                    if not g_dest.query_exists():
+                        if not test_mode:
+                            if self.defer_rename(g_source, g_dest, is_native):
+                                deferred_renames.append([src_file, dst_file, g_source, g_dest,
+                                                         is_native])
+                                continue
+                            self.rename_file(g_source, g_dest, is_native)
+                            self.after_rename(src_file, dst_file, is_native)
+                            self.add_durable_rename(src_file, dst_file, is_native)
+                            self.rename_count += 1
+                        self.report_rename(src_file, dst_file, is_silent, not test_mode)
+                    else:
+                        self.report_rename(src_file, None, is_silent, False,
+                                           STATE_ALREADY_EXISTS)
+                if deferred_renames:
+                    self.apply_deferred_renames(deferred_renames, is_silent)
+            finally:
+                self.commit_durable_renames()
+            self.clear_caches()
 
     def display_descriptions(self):
         for index, filename in enumerate(self.files):
             state = self.files_state[index]
             if state != STATE_RENAMED:
-                sys.stdout.write(f"{filename}: {self.get_state_description(state)}\n")
+                self.output.write_record(self.get_file_record(filename, None, state))
 
     def console_mode_rename_ready(self, is_sync):
-        self.generate_new_names(self.args.start_index, self.args.reg_ex, self.args.include_ext,
-                                self.args.find, self.args.replace)
+        with self.stats.phase("generate_new_names"):
+            self.generate_new_names(self.args.start_index, self.args.reg_ex,
+                                    self.args.include_ext, self.args.find, self.args.replace)
+        self.report_regex_diagnostics(self.args.reg_ex, self.args.find)
         if not self.allow_renames:
             if self.exception:
-                sys.stderr.write(_("Error") + f" {self.exception}\n")
+                self.write_error(_("Error") + f" {self.exception}")
             else:
                 self.display_descriptions()
+                self.output.close()
             exit(1)
-        self.console_apply_renames(self.args.test_mode)
-        if self.rename_count:
-            sys.stdout.write((_('%d files renamed') % self.rename_count) + "\n")
-        self.display_descriptions()
+        save_plan = getattr(self.args, "save_plan", None)
+        if save_plan:
+            self.save_plan(save_plan)
+        self.console_mode_apply(self.args.test_mode or bool(save_plan))
+
+    def console_mode_apply(self, test_mode):
+        with self.stats.phase("apply_renames"):
+            self.console_apply_renames(test_mode)
+        self.stats.count("renames", self.rename_count)
+        with self.stats.phase("output"):
+            self.output.write_summary(self.rename_count)
+            self.display_descriptions()
+            self.output.close(self.rename_count)
+
+    def write_error(self, text):
+        self.output.flush()
+        sys.stderr.write(text + "\n")
 
     def console_mode_rename(self):
-        self.add_source_files()
-        if not self.files:
-            sys.stderr.write(_("No files") + "\n")
+        try:
+            if getattr(self.args, "apply_plan", None):
+                return self.console_mode_apply_plan()
+            with self.stats.phase("add_files"):
+                self.add_source_files()
+            if not self.files:
+                self.write_error(_("No files"))
+                exit(1)
+            self.init_plugins(self.get_replace_texts(), self.console_mode_rename_ready, True)
+        finally:
+            self.dir_fds.clear()
+            self.stats.write(self.args)
+
+    # Plans
+
+    def save_plan(self, plan_file):
+        with open(plan_file, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"version": PLAN_VERSION}) + "\n")
+            for src_file, dst_file in self.renames:
+                size, mtime_ns = get_file_fingerprint(src_file) or (None, None)
+                f.write(json.dumps({"src": os.path.abspath(src_file),
+                                    "dst": os.path.abspath(dst_file), "size": size,
+                                    "mtime_ns": mtime_ns}, ensure_ascii=False) + "\n")
+
+    def load_plan(self, plan_file):
+        # the sources are only checked against their fingerprint, the macros aren't evaluated,
+        # the destinations are checked when the renames are applied
+        with open(plan_file, "r", encoding="utf-8") as f:
+            if json.loads(f.readline() or "{}").get("version") != PLAN_VERSION:
+                raise ValueError(_("Invalid plan file") + f" {plan_file}")
+            for line in f:
+                entry = json.loads(line)
+                src_file, dst_file = entry["src"], entry["dst"]
+                self.files.append(src_file)
+                self.files_list_store.append([True, os.path.dirname(src_file),
+                                              os.path.basename(src_file),
+                                              os.path.basename(dst_file)])
+                if get_file_fingerprint(src_file) == (entry["size"], entry["mtime_ns"]):
+                    self.files_state.append(STATE_RENAMED)
+                    self.renames.append([src_file, dst_file])
+                else:
+                    self.files_state.append(_("Changed since the plan was saved"))
+        self.allow_renames = len(self.renames) > 0
+
+    def console_mode_apply_plan(self):
+        try:
+            with self.stats.phase("load_plan"):
+                self.load_plan(self.args.apply_plan)
+        except (OSError, ValueError, KeyError) as e:
+            self.write_error(_("Error") + f" {e}")
             exit(1)
-        self.init_plugins(self.args.replace, self.console_mode_rename_ready, True)
+        if not self.allow_renames:
+            self.display_descriptions()
+            self.output.close()
+            exit(1)
+        self.console_mode_apply(self.args.test_mode)
 
     # Plugins
 
     def prepare_plugins(self, callback, is_sync):
-        for plugin in self.plugins.values():
+        for plugin_name, plugin in self.plugins.items():
             if plugin.worker:
-                plugin.worker.prepare(plugin.new_files)
+                if plugin.new_files:
+                    with self.stats.plugin_prepare(plugin_name, len(plugin.new_files)), \
+                            plugin.lock:
+                        plugin.worker.prepare(plugin.new_files)
+                plugin.mark_prepared()
         if is_sync:
             callback(is_sync)
         else:
@@ -363,26 +1565,83 @@ class PureConsoleRename(G_FileBridge):
 
     def run_plugin_expr(self, plugin_name, macro, filename, groups):
         plugin = self.plugins.get(plugin_name)
-        return plugin.worker.eval_expr(macro, filename, groups) \
-            if plugin and plugin.worker else macro
+        if not plugin:
+            return macro
+        if not plugin.worker:
+            raise Exception(plugin.error)
+        if filename not in plugin.prepared:
+            if self.queue_lazy_prepares and plugin.filter_by_extension([filename]):
+                # the GUI isn't blocked, the file is prepared by the next background batch
+                plugin.queue_file(filename)
+                raise Exception(_("Waiting for the plugin"))
+            # files left out of the prepared batch are prepared on their first evaluation
+            with self.stats.plugin_prepare(plugin_name, 1):
+                plugin.prepare_file(filename)
+        with self.stats.plugin_eval(plugin_name):
+            return plugin.worker.eval_expr(macro, filename, groups)
+
+    def get_find_fields(self):
+        # to override, returns is_reg_ex, include_ext and find
+        return self.args.reg_ex, self.args.include_ext, self.args.find
+
+    def get_plugin_candidates(self):
+        # only the ticked files whose name matches find evaluate the plugin macros, they are
+        # prepared in a batch, the others are prepared on the first evaluation, if ever
+        files = [filename for index, filename in enumerate(self.files)
+                 if self.files_list_store[index][0]]
+        is_reg_ex, include_ext, find = self.get_find_fields()
+        # the find of the pipeline steps is applied to the result of the previous step
+        if not find or self.pipeline:
+            return files
+        try:
+            pattern = self.compile_find(find) if is_reg_ex else None
+        except Exception:
+            # the error is reported by generate_new_names
+            return files
+        candidates = []
+        slow_regex_count = len(self.slow_regex_files)
+        for filename in files:
+            text = os.path.basename(filename)
+            if not include_ext:
+                text = os.path.splitext(text)[0]
+            if pattern:
+                try:
+                    with self.regex_budget(filename):
+                        if not pattern.search(text):
+                            continue
+                except RegexTimeout:
+                    continue
+            elif find not in text:
+                continue
+            candidates.append(filename)
+        # the slow files are reported by the render
+        del self.slow_regex_files[slow_regex_count:]
+        return candidates
 
     def init_plugins(self, replace_field, callback, is_console):
-        plugin_names = set(re.findall(r"%!\{(\w+):[^}]*\}", replace_field))
-        if not plugin_names or (set(self.plugins.keys()) == set(plugin_names)
-                                and len(self.files) == self.prepared_files_count):
+        plugin_macros = {}
+        for plugin_name, macro in re.findall(r"%!\{(\w+):([^}]*)\}", replace_field):
+            plugin_macros.setdefault(plugin_name, []).append(macro)
+        plugin_names = set(plugin_macros.keys())
+        if not plugin_names:
             return callback(True)
 
         is_async = False
+        candidates = self.get_plugin_candidates()
         new_files = self.files[self.prepared_files_count:]
         for plugin_name in plugin_names:
             plugin = self.plugins.get(plugin_name)
             if not plugin:
-                plugin = Plugin(plugin_name)
-                plugin.set_new_files(self.files)
+                with self.stats.phase(f"load:{plugin_name}"):
+                    plugin = Plugin(plugin_name)
                 self.plugins[plugin_name] = plugin
-            else:
-                plugin.set_new_files(new_files)
-            is_async = is_async or plugin.is_slow
+            queued_files = plugin.take_queued_files()
+            plugin.set_new_files(list(dict.fromkeys(candidates + queued_files)) if queued_files
+                                 else candidates, new_files)
+            plugin.set_macros(plugin_macros[plugin_name])
+            is_async = is_async or (plugin.is_slow and bool(plugin.new_files))
+            # the queued files were rendered as waiting for the plugin
+            self.clear_caches(plugin.new_files + queued_files if plugin.worker else [])
 
         self.prepared_files_count = len(self.files)
 
@@ -395,6 +1654,229 @@ class PureConsoleRename(G_FileBridge):
             self.demon.start()
 
 
+# ------------------------------------------------------------------------
+#                               Daemon
+# ------------------------------------------------------------------------
+
+# Arguments sent from the client to the daemon for each job
+JOB_ARGUMENTS = ["start_index", "reg_ex", "include_ext", "find", "replace", "test_mode",
+                 "regex_engine", "regex_timeout", "on_conflict", "durable"]
+
+
+class DaemonOutputWriter(OutputWriter):
+    def __init__(self, stream):
+        super().__init__("jsonl", stream)
+
+    def write_summary(self, rename_count):
+        self.write_line(json.dumps({"summary": rename_count}))
+
+
+class DaemonRename(PureConsoleRename):
+    def __init__(self, args, plugins, stream):
+        super().__init__(args)
+        self.plugins = plugins
+        self.output = DaemonOutputWriter(stream)
+
+    def write_error(self, text):
+        self.output.write_line(json.dumps({"error": text}, ensure_ascii=False))
+
+
+class DaemonRequestHandler:
+    # socketserver is slow to import, the handler is combined with its base classes
+    # only when the daemon is started, by create_daemon_server
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        stream = io.TextIOWrapper(self.wfile, encoding="utf-8")
+        try:
+            job = json.loads(line)
+            args = argparse.Namespace(**vars(self.server.default_args))
+            for name in JOB_ARGUMENTS:
+                if name in job:
+                    setattr(args, name, job[name])
+            args.files = job.get("files") or []
+            renamer = DaemonRename(args, self.server.plugins, stream)
+            exit_code = 0
+            try:
+                renamer.console_mode_rename()
+            except SystemExit as e:
+                exit_code = e.code
+            renamer.output.write_line(json.dumps({"exit": exit_code,
+                                                  "renamed": renamer.rename_count}))
+            renamer.output.close(renamer.rename_count)
+        except Exception as e:
+            stream.write(json.dumps({"error": str(e), "exit": 1}) + "\n")
+        finally:
+            stream.flush()
+            stream.detach()
+
+
+def create_daemon_server(socket_name, default_args):
+    import socketserver
+
+    class StreamRequestHandler(DaemonRequestHandler, socketserver.StreamRequestHandler):
+        pass
+
+    class DaemonServer(socketserver.UnixStreamServer):
+        # Jobs are served one at a time, the plugin workers and their caches are kept
+        # between jobs
+        def __init__(self):
+            self.default_args = default_args
+            self.plugins = {}
+            if os.path.exists(socket_name):
+                os.unlink(socket_name)
+            # the socket is created only accessible by the user, no other user can
+            # connect between the bind and a later chmod
+            previous_umask = os.umask(0o177)
+            try:
+                super().__init__(socket_name, StreamRequestHandler)
+            finally:
+                os.umask(previous_umask)
+
+    return DaemonServer()
+
+
+def serve_daemon(socket_name, default_args):
+    with create_daemon_server(socket_name, default_args) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_name)
+
+
+def send_daemon_job(socket_name, args):
+    import socket
+    job = {name: getattr(args, name) for name in JOB_ARGUMENTS}
+    job["files"] = [os.path.abspath(filename) for filename in args.files]
+    output = OutputWriter(args.format)
+    exit_code = 1
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_name)
+        client.sendall((json.dumps(job) + "\n").encode("utf-8"))
+        for line in client.makefile("r", encoding="utf-8"):
+            record = json.loads(line)
+            if "error" in record:
+                output.flush()
+                sys.stderr.write(record["error"] + "\n")
+            if "summary" in record:
+                output.write_summary(record["summary"])
+            elif "exit" in record:
+                exit_code = record["exit"]
+                output.close(record.get("renamed", 0))
+            elif "file" in record:
+                output.write_record(record)
+    return exit_code
+
+
+# ------------------------------------------------------------------------
+#                               Watch
+# ------------------------------------------------------------------------
+
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+# The kernel queue overflowed and events were lost, or the watch was removed
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+INOTIFY_EVENT = struct.Struct("iIII")
+# Files are renamed after no new files arrive during this time, in seconds
+WATCH_BATCH_DELAY = 0.5
+WATCH_BATCH_SIZE = 1000
+
+
+class InotifyWatcher:
+    def __init__(self, dirname):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.overflowed = False
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(dirname),
+                                       IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch", dirname)
+
+    def read_names(self, timeout=None):
+        import select
+        if select.select([self.fd], [], [], timeout)[0]:
+            return self.parse_names(os.read(self.fd, 65536))
+        return []
+
+    def parse_names(self, data):
+        names = []
+        pos = 0
+        while pos < len(data):
+            _wd, mask, _cookie, name_len = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif name_len and not mask & IN_IGNORED:
+                names.append(os.fsdecode(data[pos:pos + name_len].rstrip(b"\0")))
+            pos += name_len
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_folder(dirname, args):
+    # Renames the files as they are written or moved into the folder,
+    # the sequential number and the plugins are kept between batches
+    watcher = InotifyWatcher(dirname)
+    plugins = {}
+    start_index = args.start_index
+    renamed_files = set()
+    pending_files = []
+    try:
+        while True:
+            names = watcher.read_names(WATCH_BATCH_DELAY if pending_files else None)
+            if watcher.overflowed:
+                # the files of the lost events are left with their names, renaming them on
+                # a rescan could rename again the files already renamed
+                watcher.overflowed = False
+                sys.stderr.write(_("Warning") + ": " + _(
+                    "Too many files arrived at once, some files weren't renamed") + "\n")
+            for name in names:
+                filename = os.path.join(dirname, name)
+                if filename in renamed_files:
+                    renamed_files.discard(filename)
+                elif filename not in pending_files:
+                    pending_files.append(filename)
+            if pending_files and (not names or len(pending_files) >= WATCH_BATCH_SIZE):
+                batch_args = argparse.Namespace(**vars(args))
+                batch_args.files = pending_files
+                batch_args.start_index = start_index
+                renamer = PureConsoleRename(batch_args)
+                renamer.plugins = plugins
+                try:
+                    renamer.console_mode_rename()
+                except SystemExit:
+                    pass
+                renamer.output.flush()
+                if renamer.next_index is not None:
+                    start_index = renamer.next_index
+                if not args.test_mode:
+                    renamed_files.update(dst_file for _src_file, dst_file in renamer.renames)
+                pending_files = []
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def add_service_arguments(arg_parser):
+    arg_parser.add_argument("-serve", metavar="SOCKET",
+                            help=_("Runs as a daemon serving rename jobs on an unix socket"))
+    arg_parser.add_argument("-connect", metavar="SOCKET",
+                            help=_("Sends the rename job to a daemon started with -serve"))
+    arg_parser.add_argument("-watch", metavar="DIR",
+                            help=_("Renames the files as they are added to a folder"))
+
+
 def get_argument_parser():
     arg_parser = argparse.ArgumentParser(
         epilog=format_macros_help(),
@@ -411,8 +1893,16 @@ def get_args_from_parse(arg_parser):
 def run_as_package():
     arg_parser = get_argument_parser()
     add_arguments(arg_parser)
+    add_service_arguments(arg_parser)
     args = get_args_from_parse(arg_parser)
-    PureConsoleRename(args).console_mode_rename()
+    if args.serve:
+        serve_daemon(args.serve, args)
+    elif args.watch:
+        watch_folder(args.watch, args)
+    elif args.connect:
+        exit(send_daemon_job(args.connect, args))
+    else:
+        profile_console_rename(PureConsoleRename(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+# encoding=utf-8
+# -*- coding: UTF-8 -*-
+
+# ------------------------------------------------------------------------
+# Copyright (c) 2024-2025 Alexandre Bento Freire. All rights reserved.
+# Licensed under the GPLv3 License.
+# ------------------------------------------------------------------------
+
+import threading
+import gi
+gi.require_version('Gio', '2.0')  # noqa
+from gi.repository import GLib, Gio
+
+REMOTE_BUFFER_SIZE = 1024 * 1024
+
+
+# ------------------------------------------------------------------------
+#                               GioMover
+# ------------------------------------------------------------------------
+
+class GioMover:
+    # Moves non-native files, trying first the server-side operations
+    def __init__(self, max_jobs=1, progress_callback=None):
+        self.max_jobs = max_jobs
+        self.progress_callback = progress_callback
+        self.lock = threading.Lock()
+        # concurrent moves report one at a time, so their progress lines don't interleave
+        self.report_lock = threading.Lock()
+        self.copied_bytes = {}
+        self.done_count = 0
+        self.total_count = 0
+
+    def move(self, g_source, g_dest, job_id=None):
+        g_parent = g_source.get_parent()
+        if g_parent and g_parent.equal(g_dest.get_parent()):
+            try:
+                g_source.set_display_name(g_dest.get_basename(), None)
+                return
+            except GLib.Error:
+                pass
+        try:
+            g_source.move(g_dest, Gio.FileCopyFlags.NO_FALLBACK_FOR_MOVE, None, None, None)
+            return
+        except GLib.Error:
+            pass
+        try:
+            g_source.copy(g_dest, Gio.FileCopyFlags.NONE, None, self.on_copy_progress, job_id)
+        except GLib.Error:
+            self.copy_stream(g_source, g_dest, job_id)
+        g_source.delete(None)
+
+    def copy_stream(self, g_source, g_dest, job_id):
+        src_stream = g_source.read(None)
+        try:
+            dest_stream = g_dest.replace(None, False, Gio.FileCreateFlags.NONE, None)
+            try:
+                copied_bytes = 0
+                while True:
+                    data = src_stream.read_bytes(REMOTE_BUFFER_SIZE, None)
+                    if data.get_size() == 0:
+                        break
+                    dest_stream.write_bytes(data, None)
+                    copied_bytes += data.get_size()
+                    self.on_copy_progress(copied_bytes, 0, job_id)
+            finally:
+                dest_stream.close(None)
+        finally:
+            src_stream.close(None)
+
+    def on_copy_progress(self, current_bytes, total_bytes, job_id):
+        with self.lock:
+            self.copied_bytes[job_id] = current_bytes
+        self.report()
+
+    def report(self):
+        if self.progress_callback:
+            with self.report_lock:
+                with self.lock:
+                    progress = [self.done_count, self.total_count,
+                                sum(self.copied_bytes.values())]
+                self.progress_callback(*progress)
+
+    def move_job(self, job_id, rename):
+        src_file, dst_file, g_source, g_dest, is_native = rename
+        error = None
+        try:
+            self.move(g_source, g_dest, job_id)
+        except GLib.Error as e:
+            error = e
+        with self.lock:
+            self.done_count += 1
+        self.report()
+        return [src_file, dst_file, g_source, g_dest, is_native, error]
+
+    def move_all(self, renames):
+        from concurrent.futures import ThreadPoolExecutor
+        self.total_count = len(renames)
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            return list(executor.map(self.move_job, range(len(renames)), renames))
@@ -8,6 +8,13 @@
 
 from docx import Document
 
+PLUGIN_INFO = {
+    "description": "First header of a Word document",
+    "extensions": [".doc", ".docx"],
+    "fields": ["header"],
+    "is_slow": True
+}
+
 
 class DocWorker:
     def __init__(self) -> None:
@@ -0,0 +1,135 @@
+# encoding=utf-8
+# -*- coding: UTF-8 -*-
+
+# ------------------------------------------------------------------------
+# Copyright (c) 2024-2025 Alexandre Bento Freire. All rights reserved.
+# Licensed under the GPLv3 License.
+# ------------------------------------------------------------------------
+
+import re
+import struct
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+PLUGIN_INFO = {
+    "description": "Photo capture date, camera and lens, %date:format% uses a strftime format",
+    "extensions": [".jpg", ".jpeg", ".tif", ".tiff"],
+    "fields": ["date", "make", "model", "lens"],
+    "is_slow": True
+}
+
+MAX_WORKERS = 16
+# EXIF data is limited by the APP1 segment size
+MAX_EXIF_SIZE = 65536
+DEFAULT_DATE_FORMAT = "%Y-%m-%d"
+
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_DATE_TIME = 0x0132
+TAG_EXIF_IFD = 0x8769
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_LENS_MODEL = 0xA434
+
+# %date% or %date:strftime format% or %field%
+MACRO_FIELDS = r"%date(?::((?:%[a-zA-Z%]|[^%])*))?%|%(\w+)%"
+
+
+class ExifWorker:
+    def __init__(self) -> None:
+        self.files = {}
+
+    def is_slow(self):
+        return True
+
+    def get_extensions(self):
+        return ['.jpg', '.jpeg', '.tif', '.tiff']
+
+    def eval_expr(self, macro, filename, groups):
+        fields = self.files.get(filename)
+        if not isinstance(fields, dict):
+            raise Exception(fields or "No EXIF data")
+
+        def replace_field(match):
+            if match.group(2) is None:
+                if not fields["date"]:
+                    raise Exception("No EXIF date")
+                return fields["date"].strftime(match.group(1) or DEFAULT_DATE_FORMAT)
+            return str(fields.get(match.group(2)) or "") \
+                if match.group(2) in fields else match.group(0)
+
+        return re.sub(MACRO_FIELDS, replace_field, macro).strip()
+
+    def prepare(self, files):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for filename, fields in zip(files, executor.map(self._safe_get_fields, files)):
+                self.files[filename] = fields
+
+    def _safe_get_fields(self, filename):
+        try:
+            return self._get_fields(filename)
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            return str(e) or "Invalid EXIF data"
+
+    def _get_fields(self, filename):
+        tiff = self._read_tiff(filename)
+        if not tiff:
+            raise ValueError("No EXIF data")
+        endian = "<" if tiff[:2] == b"II" else ">"
+        tags = self._read_ifd(tiff, endian, struct.unpack(endian + "I", tiff[4:8])[0])
+        if TAG_EXIF_IFD in tags:
+            tags.update(self._read_ifd(tiff, endian, tags[TAG_EXIF_IFD]))
+        date = tags.get(TAG_DATE_TIME_ORIGINAL) or tags.get(TAG_DATE_TIME)
+        try:
+            date = datetime.strptime(date, "%Y:%m:%d %H:%M:%S") if date else None
+        except ValueError:
+            date = None
+        return {
+            "date": date,
+            "make": tags.get(TAG_MAKE),
+            "model": tags.get(TAG_MODEL),
+            "lens": tags.get(TAG_LENS_MODEL)
+        }
+
+    def _read_tiff(self, filename):
+        with open(filename, "rb") as f:
+            header = f.read(4)
+            if header in [b"II*\0", b"MM\0*"]:
+                return header + f.read(MAX_EXIF_SIZE - 4)
+            if header[:2] != b"\xff\xd8":
+                raise ValueError("Unsupported file format")
+            # walks the JPEG segments headers until the APP1 EXIF segment
+            f.seek(2)
+            while True:
+                marker = f.read(4)
+                if len(marker) < 4 or marker[0] != 0xFF or marker[1] in [0xD9, 0xDA]:
+                    return None
+                if marker[1] == 0xFF:
+                    # fill bytes before the marker
+                    f.seek(-3, 1)
+                    continue
+                length = struct.unpack(">H", marker[2:4])[0]
+                if marker[1] == 0xE1:
+                    data = f.read(length - 2)
+                    if data.startswith(b"Exif\0\0"):
+                        return data[6:]
+                else:
+                    f.seek(length - 2, 1)
+
+    def _read_ifd(self, tiff, endian, offset):
+        tags = {}
+        count = struct.unpack(endian + "H", tiff[offset:offset + 2])[0]
+        for index in range(count):
+            pos = offset + 2 + index * 12
+            tag, value_type, value_count = struct.unpack(endian + "HHI", tiff[pos:pos + 8])
+            if value_type == 2:
+                value_pos = pos + 8 if value_count <= 4 else \
+                    struct.unpack(endian + "I", tiff[pos + 8:pos + 12])[0]
+                tags[tag] = tiff[value_pos:value_pos + value_count].split(b"\0")[0] \
+                    .decode("utf-8", "replace").strip()
+            elif value_type == 4:
+                tags[tag] = struct.unpack(endian + "I", tiff[pos + 8:pos + 12])[0]
+        return tags
+
+
+def get_worker():
+    return ExifWorker()
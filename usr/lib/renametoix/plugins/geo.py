@@ -10,6 +10,13 @@
 from geopy.geocoders import Nominatim
 import piexif
 
+PLUGIN_INFO = {
+    "description": "Reverse geocoding of the JPEG GPS info",
+    "extensions": [".jpg", ".jpeg"],
+    "fields": ["country", "state", "city", "postcode", "suburb"],
+    "is_slow": True
+}
+
 
 class GeoWorker:
     def __init__(self) -> None:
@@ -0,0 +1,108 @@
+# encoding=utf-8
+# -*- coding: UTF-8 -*-
+
+# ------------------------------------------------------------------------
+# Copyright (c) 2024-2025 Alexandre Bento Freire. All rights reserved.
+# Licensed under the GPLv3 License.
+# ------------------------------------------------------------------------
+
+import os
+import re
+import mmap
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+PLUGIN_INFO = {
+    "description": "Hash of the file content, %algorithm:n% uses only the first n digits",
+    "extensions": [],
+    "fields": ["md5", "sha1", "sha224", "sha256", "sha384", "sha512", "blake2b", "blake2s",
+               "sha3_224", "sha3_256", "sha3_384", "sha3_512"],
+    "is_slow": True
+}
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+DEFAULT_ALGORITHMS = ["sha256"]
+ALGORITHMS = [algorithm for algorithm in hashlib.algorithms_guaranteed
+              if not algorithm.startswith("shake_")]
+
+
+class HashWorker:
+    def __init__(self) -> None:
+        self.files = {}
+        # filename: [(size, mtime, inode), {algorithm: hexdigest}]
+        self.cache = {}
+        self.algorithms = set(DEFAULT_ALGORITHMS)
+
+    def is_slow(self):
+        return True
+
+    def get_extensions(self):
+        return []
+
+    def set_macros(self, macros):
+        algorithms = set()
+        for macro in macros:
+            for algorithm, _length in re.findall(r"%(\w+)(?::(\d+))?%", macro):
+                if algorithm.lower() in ALGORITHMS:
+                    algorithms.add(algorithm.lower())
+        self.algorithms = algorithms or set(DEFAULT_ALGORITHMS)
+
+    def eval_expr(self, macro, filename, groups):
+        digests = self.files.get(filename)
+        if not isinstance(digests, dict):
+            raise Exception(digests or "No hash")
+
+        def replace_field(match):
+            algorithm = match.group(1).lower()
+            if algorithm not in ALGORITHMS:
+                return match.group(0)
+            digest = digests.get(algorithm)
+            if not digest:
+                # algorithm not requested on prepare
+                digest = self._hash_file(filename, [algorithm])[algorithm]
+            return digest[:int(match.group(2))] if match.group(2) else digest
+
+        return re.sub(r"%(\w+)(?::(\d+))?%", replace_field, macro)
+
+    def prepare(self, files):
+        algorithms = sorted(self.algorithms)
+        # hashlib releases the GIL while hashing large blocks
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2)) as executor:
+            for filename, digests in zip(files, executor.map(
+                    lambda filename: self._safe_hash_file(filename, algorithms), files)):
+                self.files[filename] = digests
+
+    def _safe_hash_file(self, filename, algorithms):
+        try:
+            return self._hash_file(filename, algorithms)
+        except OSError as e:
+            return e.strerror or str(e)
+
+    def _hash_file(self, filename, algorithms):
+        file_stat = os.stat(filename)
+        fingerprint = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        cached_fingerprint, digests = self.cache.get(filename) or (None, {})
+        if cached_fingerprint != fingerprint:
+            digests = {}
+        missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+        if missing:
+            hashers = [hashlib.new(algorithm) for algorithm in missing]
+            if file_stat.st_size:
+                with open(filename, "rb") as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        for pos in range(0, len(view), HASH_BLOCK_SIZE):
+                            for hasher in hashers:
+                                hasher.update(view[pos:pos + HASH_BLOCK_SIZE])
+                    finally:
+                        view.release()
+            digests = dict(digests)
+            for algorithm, hasher in zip(missing, hashers):
+                digests[algorithm] = hasher.hexdigest()
+            self.cache[filename] = [fingerprint, digests]
+        return digests
+
+
+def get_worker():
+    return HashWorker()
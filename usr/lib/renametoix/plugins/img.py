@@ -0,0 +1,126 @@
+# encoding=utf-8
+# -*- coding: UTF-8 -*-
+
+# ------------------------------------------------------------------------
+# Copyright (c) 2024-2025 Alexandre Bento Freire. All rights reserved.
+# Licensed under the GPLv3 License.
+# ------------------------------------------------------------------------
+
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+PLUGIN_INFO = {
+    "description": "Image dimensions read from the file header",
+    "extensions": [".jpg", ".jpeg", ".png", ".gif", ".webp"],
+    "fields": ["width", "height", "orientation"],
+    "is_slow": True
+}
+
+HEADER_SIZE = 32
+MAX_WORKERS = 16
+# JPEG start of frame markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class ImgWorker:
+    def __init__(self) -> None:
+        self.files = {}
+
+    def is_slow(self):
+        return True
+
+    def get_extensions(self):
+        return ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+
+    def eval_expr(self, macro, filename, groups):
+        fields = self.files.get(filename)
+        if not isinstance(fields, dict):
+            raise Exception(fields or "No image size")
+        result = macro
+        for key in fields.keys():
+            result = result.replace(f"%{key}%", str(fields[key]))
+        return result
+
+    def prepare(self, files):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for filename, fields in zip(files, executor.map(self._safe_get_fields, files)):
+                self.files[filename] = fields
+
+    def _safe_get_fields(self, filename):
+        try:
+            return self._get_fields(filename)
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            return str(e) or "Invalid image"
+
+    def _get_fields(self, filename):
+        with open(filename, "rb") as f:
+            header = f.read(HEADER_SIZE)
+            rotation = 1
+            if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+                width, height = struct.unpack(">II", header[16:24])
+            elif header[:6] in [b"GIF87a", b"GIF89a"]:
+                width, height = struct.unpack("<HH", header[6:10])
+            elif header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+                width, height = self._get_webp_size(header)
+            elif header[:2] == b"\xff\xd8":
+                width, height, rotation = self._get_jpeg_size(f)
+            else:
+                raise ValueError("Unsupported image format")
+        if rotation in [5, 6, 7, 8]:
+            width, height = height, width
+        return {
+            "width": width,
+            "height": height,
+            "orientation": "landscape" if width > height else
+            "portrait" if width < height else "square"
+        }
+
+    def _get_webp_size(self, header):
+        chunk = header[12:16]
+        if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", header[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L" and header[20] == 0x2F:
+            bits = int.from_bytes(header[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(header[24:27], "little") + 1, \
+                int.from_bytes(header[27:30], "little") + 1
+        raise ValueError("Invalid WebP header")
+
+    def _get_jpeg_size(self, f):
+        # walks the segments headers, seeking over their data
+        rotation = 1
+        f.seek(2)
+        while True:
+            marker = f.read(4)
+            if len(marker) < 4 or marker[0] != 0xFF:
+                raise ValueError("Invalid JPEG header")
+            if marker[1] == 0xFF:
+                f.seek(-3, 1)
+                continue
+            length = struct.unpack(">H", marker[2:4])[0]
+            if marker[1] in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">xHH", f.read(5))
+                return width, height, rotation
+            if marker[1] == 0xE1:
+                data = f.read(length - 2)
+                if data.startswith(b"Exif\0\0"):
+                    rotation = self._get_exif_orientation(data[6:]) or rotation
+            else:
+                f.seek(length - 2, 1)
+
+    def _get_exif_orientation(self, tiff):
+        endian = "<" if tiff[:2] == b"II" else ">"
+        ifd_offset = struct.unpack(endian + "I", tiff[4:8])[0]
+        count = struct.unpack(endian + "H", tiff[ifd_offset:ifd_offset + 2])[0]
+        for index in range(count):
+            pos = ifd_offset + 2 + index * 12
+            tag, _type, _count = struct.unpack(endian + "HHI", tiff[pos:pos + 8])
+            if tag == 0x0112:
+                return struct.unpack(endian + "H", tiff[pos + 8:pos + 10])[0]
+        return None
+
+
+def get_worker():
+    return ImgWorker()
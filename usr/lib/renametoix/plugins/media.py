@@ -0,0 +1,269 @@
+# encoding=utf-8
+# -*- coding: UTF-8 -*-
+
+# ------------------------------------------------------------------------
+# Copyright (c) 2024-2025 Alexandre Bento Freire. All rights reserved.
+# Licensed under the GPLv3 License.
+# ------------------------------------------------------------------------
+
+import io
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+PLUGIN_INFO = {
+    "description": "Audio and video tags",
+    "extensions": [".mp3", ".flac", ".m4a", ".m4b", ".mp4", ".m4v", ".mov"],
+    "fields": ["artist", "album", "track", "title", "duration"],
+    "is_slow": True
+}
+
+MAX_WORKERS = 16
+# Larger text frames or atoms aren't tags, they are skipped
+MAX_TEXT_SIZE = 65536
+
+ID3_FRAMES = {
+    "TPE1": "artist", "TP1": "artist",
+    "TALB": "album", "TAL": "album",
+    "TRCK": "track", "TRK": "track",
+    "TIT2": "title", "TT2": "title",
+    "TLEN": "duration", "TLE": "duration"
+}
+
+# ID3v2 tag header flags, and v2.4 frame format flags
+ID3_UNSYNCHRONISATION = 0x80
+ID3_EXTENDED_HEADER = 0x40
+ID3_FRAME_UNSYNCHRONISATION = 0x02
+ID3_FRAME_DATA_LENGTH = 0x01
+
+VORBIS_FIELDS = {"ARTIST": "artist", "ALBUM": "album", "TRACKNUMBER": "track", "TITLE": "title"}
+
+MP4_ATOMS = {b"\xa9ART": "artist", b"\xa9alb": "album", b"\xa9nam": "title", b"trkn": "track"}
+MP4_CONTAINERS = [b"moov", b"udta", b"ilst"] + list(MP4_ATOMS.keys())
+
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+MP3_SAMPLE_RATES = [44100, 48000, 32000]
+
+
+class MediaWorker:
+    def __init__(self) -> None:
+        self.files = {}
+
+    def is_slow(self):
+        return True
+
+    def get_extensions(self):
+        return ['.mp3', '.flac', '.m4a', '.m4b', '.mp4', '.m4v', '.mov']
+
+    def eval_expr(self, macro, filename, groups):
+        fields = self.files.get(filename)
+        if not isinstance(fields, dict):
+            raise Exception(fields or "No media tags")
+        result = macro
+        for key in ["artist", "album", "track", "title", "duration"]:
+            result = result.replace(f"%{key}%", str(fields.get(key) or "").strip(",;- "))
+        return result
+
+    def prepare(self, files):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for filename, fields in zip(files, executor.map(self._safe_get_fields, files)):
+                self.files[filename] = fields
+
+    def _safe_get_fields(self, filename):
+        try:
+            return self._get_fields(filename)
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            return str(e) or "Invalid media file"
+
+    def _get_fields(self, filename):
+        with open(filename, "rb") as f:
+            header = f.read(12)
+            f.seek(0)
+            if header[:3] == b"ID3" or os.path.splitext(filename)[1].lower() == ".mp3":
+                fields = self._get_id3_fields(f)
+            elif header[:4] == b"fLaC":
+                fields = self._get_flac_fields(f)
+            elif header[4:8] == b"ftyp":
+                fields = self._get_mp4_fields(f)
+            else:
+                raise ValueError("Unsupported media format")
+        track = str(fields.get("track") or "").split("/")[0].strip()
+        fields["track"] = track.zfill(2) if track.isdigit() else track
+        return fields
+
+    # ID3v2
+
+    def _get_id3_fields(self, f):
+        fields = {}
+        header = f.read(10)
+        audio_start = 0
+        if header[:3] == b"ID3":
+            version = header[3]
+            flags = header[5]
+            tag_end = 10 + self._syncsafe(header[6:10])
+            audio_start = tag_end
+            tag = f
+            if flags & ID3_UNSYNCHRONISATION and version < 4:
+                # up to v2.3 the whole tag is unsynchronised, the frames sizes are of the
+                # restored data, v2.4 unsynchronises each frame data
+                data = self._resynchronise(f.read(tag_end - 10))
+                tag = io.BytesIO(bytes(10) + data)
+                tag.seek(10)
+                tag_end = 10 + len(data)
+            if flags & ID3_EXTENDED_HEADER and version > 2:
+                # the v2.4 size is syncsafe and includes its 4 bytes
+                size = tag.read(4)
+                tag.seek(self._syncsafe(size) - 4 if version == 4
+                         else int.from_bytes(size, "big"), 1)
+            frame_header_size = 6 if version == 2 else 10
+            while tag.tell() + frame_header_size <= tag_end:
+                frame = tag.read(frame_header_size)
+                if not frame or frame[0] == 0:
+                    break
+                if version == 2:
+                    frame_id = frame[:3].decode("latin-1")
+                    size = int.from_bytes(frame[3:6], "big")
+                else:
+                    frame_id = frame[:4].decode("latin-1")
+                    size = self._syncsafe(frame[4:8]) if version == 4 \
+                        else int.from_bytes(frame[4:8], "big")
+                field = ID3_FRAMES.get(frame_id)
+                if field and size <= MAX_TEXT_SIZE:
+                    data = tag.read(size)
+                    if version == 4:
+                        if flags & ID3_UNSYNCHRONISATION or frame[9] & ID3_FRAME_UNSYNCHRONISATION:
+                            data = self._resynchronise(data)
+                        if frame[9] & ID3_FRAME_DATA_LENGTH:
+                            data = data[4:]
+                    fields[field] = self._decode_id3_text(data)
+                else:
+                    tag.seek(size, 1)
+        if fields.get("duration"):
+            fields["duration"] = int(fields["duration"]) // 1000 \
+                if fields["duration"].isdigit() else None
+        if not fields.get("duration"):
+            fields["duration"] = self._get_mp3_duration(f, audio_start)
+        return fields
+
+    def _syncsafe(self, data):
+        return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+    def _resynchronise(self, data):
+        return data.replace(b"\xff\x00", b"\xff")
+
+    def _decode_id3_text(self, data):
+        encoding = ["latin-1", "utf-16", "utf-16-be", "utf-8"][data[0]] \
+            if data and data[0] < 4 else "latin-1"
+        return data[1:].decode(encoding, "replace").split("\0")[0].strip()
+
+    def _get_mp3_duration(self, f, audio_start):
+        # uses the Xing/Info header of the first frame, otherwise assumes constant bitrate
+        f.seek(audio_start)
+        data = f.read(256)
+        pos = data.find(b"\xff")
+        while pos >= 0 and pos + 4 <= len(data) and (data[pos + 1] & 0xE0) != 0xE0:
+            pos = data.find(b"\xff", pos + 1)
+        if pos < 0 or pos + 4 > len(data):
+            return None
+        frame_header = int.from_bytes(data[pos:pos + 4], "big")
+        version_bits = (frame_header >> 19) & 3
+        bitrate_index = (frame_header >> 12) & 15
+        sample_rate_index = (frame_header >> 10) & 3
+        if version_bits == 1 or sample_rate_index == 3 or bitrate_index in [0, 15]:
+            return None
+        version = 1 if version_bits == 3 else 2
+        # MPEG 2 and 2.5 have half and a quarter of the MPEG 1 sample rates
+        sample_rate = MP3_SAMPLE_RATES[sample_rate_index] >> {3: 0, 2: 1, 0: 2}[version_bits]
+        is_mono = ((frame_header >> 6) & 3) == 3
+        xing_pos = pos + 4 + ((17 if is_mono else 32) if version == 1 else (9 if is_mono else 17))
+        if data[xing_pos:xing_pos + 4] in [b"Xing", b"Info"] and data[xing_pos + 7] & 1:
+            frames = int.from_bytes(data[xing_pos + 8:xing_pos + 12], "big")
+            return frames * (1152 if version == 1 else 576) // sample_rate
+        audio_size = os.fstat(f.fileno()).st_size - audio_start - pos
+        return audio_size * 8 // (MP3_BITRATES[version][bitrate_index] * 1000)
+
+    # FLAC
+
+    def _get_flac_fields(self, f):
+        fields = {}
+        f.seek(4)
+        is_last = False
+        while not is_last:
+            block_header = f.read(4)
+            if len(block_header) < 4:
+                break
+            is_last = bool(block_header[0] & 0x80)
+            block_type = block_header[0] & 0x7F
+            size = int.from_bytes(block_header[1:4], "big")
+            if block_type == 0:
+                info = f.read(size)
+                bits = int.from_bytes(info[10:18], "big")
+                sample_rate = bits >> 44
+                total_samples = bits & 0xFFFFFFFFF
+                fields["duration"] = total_samples // sample_rate if sample_rate else None
+            elif block_type == 4:
+                self._read_vorbis_comment(f.read(size), fields)
+            else:
+                f.seek(size, 1)
+        return fields
+
+    def _read_vorbis_comment(self, data, fields):
+        pos = 4 + struct.unpack("<I", data[:4])[0]
+        count = struct.unpack("<I", data[pos:pos + 4])[0]
+        pos += 4
+        for _ in range(count):
+            size = struct.unpack("<I", data[pos:pos + 4])[0]
+            key, _sep, value = data[pos + 4:pos + 4 + size].decode("utf-8", "replace") \
+                .partition("=")
+            field = VORBIS_FIELDS.get(key.upper())
+            if field and field not in fields:
+                fields[field] = value.strip()
+            pos += 4 + size
+
+    # MP4
+
+    def _get_mp4_fields(self, f):
+        fields = {}
+        self._walk_mp4_atoms(f, 0, os.fstat(f.fileno()).st_size, fields)
+        return fields
+
+    def _walk_mp4_atoms(self, f, start, end, fields, parent=None):
+        # seeks from atom header to atom header, only mvhd and the tags are read
+        pos = start
+        while pos + 8 <= end:
+            f.seek(pos)
+            size, atom_type = struct.unpack(">I4s", f.read(8))
+            header_size = 8
+            if size == 1:
+                size = struct.unpack(">Q", f.read(8))[0]
+                header_size = 16
+            elif size == 0:
+                size = end - pos
+            if size < header_size:
+                break
+            data_start = pos + header_size
+            if atom_type == b"mvhd":
+                data = f.read(32)
+                if data[0] == 1:
+                    timescale, duration = struct.unpack(">IQ", data[20:32])
+                else:
+                    timescale, duration = struct.unpack(">II", data[12:20])
+                fields["duration"] = duration // timescale if timescale else None
+            elif atom_type == b"meta":
+                # meta is a full atom, the children start after the version and flags
+                self._walk_mp4_atoms(f, data_start + 4, pos + size, fields, atom_type)
+            elif atom_type == b"data" and parent in MP4_ATOMS and size <= MAX_TEXT_SIZE:
+                data = f.read(size - header_size)
+                value = data[8:]
+                fields[MP4_ATOMS[parent]] = str(struct.unpack(">H", value[2:4])[0]) \
+                    if parent == b"trkn" else value.decode("utf-8", "replace").strip()
+            elif atom_type in MP4_CONTAINERS:
+                self._walk_mp4_atoms(f, data_start, pos + size, fields, atom_type)
+            pos += size
+
+
+def get_worker():
+    return MediaWorker()
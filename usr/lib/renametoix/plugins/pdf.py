@@ -0,0 +1,436 @@
+# encoding=utf-8
+# -*- coding: UTF-8 -*-
+
+# ------------------------------------------------------------------------
+# Copyright (c) 2024-2025 Alexandre Bento Freire. All rights reserved.
+# Licensed under the GPLv3 License.
+# ------------------------------------------------------------------------
+
+# cSpell:ignoreRegExp (startxref|endstream|endobj|ObjStm|XRefStm|Paeth)
+import os
+import re
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+PLUGIN_INFO = {
+    "description": "PDF title, author and creation date",
+    "extensions": [".pdf"],
+    "fields": ["title", "author", "created"],
+    "is_slow": True
+}
+
+MAX_WORKERS = 16
+TAIL_SIZE = 2048
+OBJECT_READ_SIZE = 4096
+MAX_OBJECT_SIZE = 1024 * 1024
+XREF_ENTRY_SIZE = 20
+
+WHITESPACE = b"\0\t\n\f\r "
+DELIMITERS = WHITESPACE + b"()<>[]{}/%"
+ESCAPES = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t", ord("b"): b"\b", ord("f"): b"\f"}
+
+# the generation and R that follow an int when it's a reference
+REF_PATTERN = re.compile(rb"\s+(\d+)\s+R(?=[" + re.escape(DELIMITERS) + rb"])")
+
+Ref = namedtuple("Ref", ["num", "gen"])
+
+
+class Name(str):
+    pass
+
+
+class PdfError(ValueError):
+    pass
+
+
+# ------------------------------------------------------------------------
+#                               PdfParser
+# ------------------------------------------------------------------------
+
+class PdfParser:
+    # Parses the PDF objects syntax, raises IndexError if the data is truncated
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def skip_space(self):
+        data = self.data
+        while self.pos < len(data):
+            if data[self.pos] in WHITESPACE:
+                self.pos += 1
+            elif data[self.pos] == ord("%"):
+                while self.pos < len(data) and data[self.pos] not in b"\r\n":
+                    self.pos += 1
+            else:
+                break
+
+    def read_token(self):
+        self.skip_space()
+        start = self.pos
+        while self.pos < len(self.data) and self.data[self.pos] not in DELIMITERS:
+            self.pos += 1
+        if self.pos == len(self.data):
+            raise IndexError("Truncated data")
+        return self.data[start:self.pos]
+
+    def parse(self):
+        self.skip_space()
+        data = self.data
+        char = data[self.pos]
+        if data.startswith(b"<<", self.pos):
+            self.pos += 2
+            result = {}
+            while True:
+                self.skip_space()
+                if data.startswith(b">>", self.pos):
+                    self.pos += 2
+                    return result
+                key = self.parse()
+                result[key] = self.parse()
+        if char == ord("["):
+            self.pos += 1
+            result = []
+            while True:
+                self.skip_space()
+                if data[self.pos] == ord("]"):
+                    self.pos += 1
+                    return result
+                result.append(self.parse())
+        if char == ord("("):
+            return self.parse_literal_string()
+        if char == ord("<"):
+            end = data.find(b">", self.pos)
+            if end < 0:
+                raise IndexError("Truncated data")
+            hex_text = re.sub(rb"\s", b"", data[self.pos + 1:end])
+            self.pos = end + 1
+            return bytes.fromhex((hex_text + b"0" * (len(hex_text) % 2)).decode("ascii"))
+        if char == ord("/"):
+            self.pos += 1
+            return Name(re.sub(r"#([0-9A-Fa-f]{2})", lambda m: chr(int(m.group(1), 16)),
+                               self.read_token().decode("latin-1")))
+        token = self.read_token()
+        if not token:
+            raise PdfError(f"Unexpected character {chr(char)}")
+        if re.fullmatch(rb"[+-]?\d+", token):
+            # int or reference: num gen R
+            match = REF_PATTERN.match(data, self.pos)
+            if match:
+                self.pos = match.end()
+                return Ref(int(token), int(match.group(1)))
+            return int(token)
+        if re.fullmatch(rb"[+-]?\d*\.\d*", token):
+            return float(token)
+        return {b"true": True, b"false": False, b"null": None}.get(token, Name(token.decode(
+            "latin-1")))
+
+    def parse_literal_string(self):
+        data = self.data
+        self.pos += 1
+        depth = 1
+        result = bytearray()
+        while True:
+            char = data[self.pos]
+            self.pos += 1
+            if char == ord("\\"):
+                char = data[self.pos]
+                self.pos += 1
+                if char in ESCAPES:
+                    result += ESCAPES[char]
+                elif ord("0") <= char <= ord("7"):
+                    octal = re.match(rb"[0-7]{1,3}", data[self.pos - 1:self.pos + 2]).group(0)
+                    self.pos += len(octal) - 1
+                    result.append(int(octal, 8) & 0xFF)
+                elif char == ord("\r"):
+                    if data[self.pos] == ord("\n"):
+                        self.pos += 1
+                elif char != ord("\n"):
+                    result.append(char)
+                continue
+            if char == ord("("):
+                depth += 1
+            elif char == ord(")"):
+                depth -= 1
+                if not depth:
+                    return bytes(result)
+            result.append(char)
+
+
+# ------------------------------------------------------------------------
+#                               PdfReader
+# ------------------------------------------------------------------------
+
+class PdfReader:
+    # Resolves objects through the cross-reference tables, reading only what is required
+    def __init__(self, f):
+        self.f = f
+        self.size = os.fstat(f.fileno()).st_size
+        # list of sections, newest first: [subsections or entries, is_stream]
+        self.sections = []
+        self.object_streams = {}
+        self.trailer = {}
+
+    def read_at(self, pos, size):
+        self.f.seek(pos)
+        return self.f.read(size)
+
+    def load_trailer(self):
+        tail = self.read_at(max(0, self.size - TAIL_SIZE), TAIL_SIZE)
+        match = re.search(rb"startxref\s+(\d+)", tail[tail.rfind(b"startxref"):])
+        if not match:
+            raise PdfError("No startxref")
+        offset = int(match.group(1))
+        visited = set()
+        while offset is not None and offset not in visited:
+            visited.add(offset)
+            trailer = self.load_xref(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            if "XRefStm" in trailer:
+                self.load_xref(trailer["XRefStm"])
+            offset = trailer.get("Prev")
+        if "Encrypt" in self.trailer:
+            raise PdfError("Encrypted PDF")
+
+    def load_xref(self, offset):
+        data = self.read_at(offset, OBJECT_READ_SIZE)
+        if not data.startswith(b"xref"):
+            xref_dict, stream = self.read_object_at(offset)
+            self.sections.append([self.parse_xref_stream(xref_dict, stream), True])
+            return xref_dict
+        # classic table: only the subsections headers are read, entries are read on lookup
+        subsections = []
+        pos = offset + 4
+        while True:
+            data = self.read_at(pos, 64)
+            match = re.match(rb"\s*(\d+)\s+(\d+)[ \t]*\r?\n?", data)
+            if not match:
+                break
+            start, count = int(match.group(1)), int(match.group(2))
+            subsections.append([start, count, pos + match.end()])
+            pos += match.end() + count * XREF_ENTRY_SIZE
+        self.sections.append([subsections, False])
+        data = self.read_at(pos, OBJECT_READ_SIZE)
+        trailer_pos = data.find(b"trailer")
+        if trailer_pos < 0:
+            raise PdfError("No trailer")
+        return self.parse_at(pos + trailer_pos + 7)
+
+    def parse_xref_stream(self, xref_dict, stream):
+        widths = xref_dict["W"]
+        index = xref_dict.get("Index") or [0, xref_dict["Size"]]
+        row_size = sum(widths)
+        entries = {}
+        pos = 0
+        for section in range(0, len(index), 2):
+            for num in range(index[section], index[section] + index[section + 1]):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(stream[pos:pos + width], "big"))
+                    pos += width
+                if widths[0] == 0:
+                    fields[0] = 1
+                entries[num] = fields
+                if pos + row_size > len(stream):
+                    return entries
+        return entries
+
+    def lookup(self, num):
+        for entries, is_stream in self.sections:
+            if is_stream:
+                if num in entries and entries[num][0] in [1, 2]:
+                    return entries[num]
+                continue
+            for start, count, pos in entries:
+                if start <= num < start + count:
+                    entry = self.read_at(pos + (num - start) * XREF_ENTRY_SIZE,
+                                         XREF_ENTRY_SIZE)
+                    if entry[17:18] == b"n":
+                        return [1, int(entry[:10]), 0]
+        return None
+
+    def resolve(self, value):
+        if not isinstance(value, Ref):
+            return value
+        entry = self.lookup(value.num)
+        if not entry:
+            return None
+        if entry[0] == 1:
+            return self.read_object_at(entry[1])[0]
+        return self.read_compressed_object(entry[1], entry[2])
+
+    def resolve_stream(self, ref):
+        entry = self.lookup(ref.num) if isinstance(ref, Ref) else None
+        if not entry or entry[0] != 1:
+            return None
+        return self.read_object_at(entry[1])[1]
+
+    def read_compressed_object(self, stream_num, index):
+        if stream_num not in self.object_streams:
+            stream_dict, stream = self.read_object_at(self.lookup(stream_num)[1])
+            count, first = stream_dict["N"], stream_dict["First"]
+            parser = PdfParser(stream)
+            offsets = [parser.parse() for _ in range(count * 2)][1::2]
+            self.object_streams[stream_num] = [stream, first, offsets]
+        stream, first, offsets = self.object_streams[stream_num]
+        return PdfParser(stream, first + offsets[index]).parse()
+
+    def parse_at(self, pos):
+        read_size = OBJECT_READ_SIZE
+        while True:
+            data = self.read_at(pos, read_size)
+            try:
+                parser = PdfParser(data)
+                return parser.parse()
+            except IndexError:
+                if len(data) < read_size or read_size >= MAX_OBJECT_SIZE:
+                    raise PdfError("Truncated object")
+                read_size *= 4
+
+    def read_object_at(self, pos):
+        read_size = OBJECT_READ_SIZE
+        while True:
+            data = self.read_at(pos, read_size)
+            try:
+                parser = PdfParser(data)
+                if not re.match(rb"\s*\d+\s+\d+\s+obj", data):
+                    raise PdfError("Invalid object offset")
+                parser.pos = data.index(b"obj") + 3
+                value = parser.parse()
+                parser.skip_space()
+                is_stream = data.startswith(b"stream", parser.pos)
+                break
+            except IndexError:
+                if len(data) < read_size or read_size >= MAX_OBJECT_SIZE:
+                    raise PdfError("Truncated object")
+                read_size *= 4
+        if not is_stream or not isinstance(value, dict):
+            return value, None
+        stream_pos = parser.pos + 6
+        stream_pos += 2 if data[stream_pos:stream_pos + 2] == b"\r\n" else 1
+        length = self.resolve(value.get("Length"))
+        if not isinstance(length, int) or length > MAX_OBJECT_SIZE:
+            raise PdfError("Invalid stream length")
+        return value, self.decode_stream(value, self.read_at(pos + stream_pos, length))
+
+    def decode_stream(self, stream_dict, stream):
+        filters = stream_dict.get("Filter") or []
+        filters = filters if isinstance(filters, list) else [filters]
+        for filter_name in filters:
+            if filter_name != "FlateDecode":
+                raise PdfError(f"Unsupported filter {filter_name}")
+            stream = zlib.decompress(stream)
+        params = stream_dict.get("DecodeParms") or {}
+        params = params[0] if isinstance(params, list) else params
+        if isinstance(params, dict) and (params.get("Predictor") or 1) >= 10:
+            stream = self.undo_png_predictor(stream, params.get("Columns") or 1)
+        return stream
+
+    def undo_png_predictor(self, stream, columns):
+        result = bytearray()
+        previous = bytearray(columns)
+        for pos in range(0, len(stream) - columns, columns + 1):
+            predictor = stream[pos]
+            row = bytearray(stream[pos + 1:pos + 1 + columns])
+            for index in range(columns):
+                left = row[index - 1] if index else 0
+                up = previous[index]
+                up_left = previous[index - 1] if index else 0
+                if predictor == 1:
+                    row[index] = (row[index] + left) & 0xFF
+                elif predictor == 2:
+                    row[index] = (row[index] + up) & 0xFF
+                elif predictor == 3:
+                    row[index] = (row[index] + (left + up) // 2) & 0xFF
+                elif predictor == 4:
+                    estimate = left + up - up_left
+                    distances = [abs(estimate - left), abs(estimate - up),
+                                 abs(estimate - up_left)]
+                    row[index] = (row[index] + [left, up, up_left][
+                        distances.index(min(distances))]) & 0xFF
+            result += row
+            previous = row
+        return bytes(result)
+
+
+def decode_text(value):
+    if not isinstance(value, bytes):
+        return str(value) if value is not None else None
+    if value.startswith(b"\xfe\xff"):
+        return value[2:].decode("utf-16-be", "replace")
+    if value.startswith(b"\xef\xbb\xbf"):
+        return value[3:].decode("utf-8", "replace")
+    return value.decode("latin-1")
+
+
+# ------------------------------------------------------------------------
+#                               PdfWorker
+# ------------------------------------------------------------------------
+
+class PdfWorker:
+    def __init__(self) -> None:
+        self.files = {}
+
+    def is_slow(self):
+        return True
+
+    def get_extensions(self):
+        return ['.pdf']
+
+    def eval_expr(self, macro, filename, groups):
+        fields = self.files.get(filename)
+        if not isinstance(fields, dict):
+            raise Exception(fields or "No PDF metadata")
+        result = macro
+        for key in ["title", "author", "created"]:
+            result = result.replace(f"%{key}%", (fields.get(key) or "").strip(",;- "))
+        return result
+
+    def prepare(self, files):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for filename, fields in zip(files, executor.map(self._safe_get_fields, files)):
+                self.files[filename] = fields
+
+    def _safe_get_fields(self, filename):
+        try:
+            return self._get_fields(filename)
+        except (OSError, ValueError, IndexError, KeyError, TypeError, zlib.error) as e:
+            return str(e) or "Invalid PDF"
+
+    def _get_fields(self, filename):
+        with open(filename, "rb") as f:
+            reader = PdfReader(f)
+            reader.load_trailer()
+            info = reader.resolve(reader.trailer.get("Info"))
+            info = info if isinstance(info, dict) else {}
+            title = decode_text(reader.resolve(info.get("Title")))
+            if not title:
+                # a broken XMP stream must not lose the Info fields
+                try:
+                    title = self._get_xmp_title(reader)
+                except (OSError, ValueError, IndexError, KeyError, TypeError, zlib.error):
+                    title = None
+            created = decode_text(reader.resolve(info.get("CreationDate"))) or ""
+            match = re.match(r"(?:D:)?(\d{4})(\d{2})?(\d{2})?", created)
+            return {
+                "title": (title or "").strip(),
+                "author": (decode_text(reader.resolve(info.get("Author"))) or "").strip(),
+                "created": "-".join(part for part in match.groups() if part) if match else ""
+            }
+
+    def _get_xmp_title(self, reader):
+        root = reader.resolve(reader.trailer.get("Root"))
+        if not isinstance(root, dict):
+            return None
+        xmp = reader.resolve_stream(root.get("Metadata"))
+        match = re.search(rb"<dc:title>.*?<rdf:li[^>]*>(.*?)</rdf:li>", xmp or b"", re.S)
+        if not match:
+            return None
+        return re.sub(r"&(lt|gt|amp|quot|apos);", lambda m: {
+            "lt": "<", "gt": ">", "amp": "&", "quot": '"', "apos": "'"}[m.group(1)],
+            match.group(1).decode("utf-8", "replace"))
+
+
+def get_worker():
+    return PdfWorker()
@@ -11,19 +11,18 @@
 import io
 import os
 import re
-import setproctitle
 import stat
 import sys
+import json
 import time
-import yaml
 import gettext
 import locale
 import crenametoix
 
-import gi
-gi.require_version("Gtk", "3.0")  # noqa
-gi.require_version('Gio', '2.0')  # noqa
-from gi.repository import Gtk, Gdk, GLib, Gio
+# gi and yaml are slow to import, they are loaded only when required
+Gtk = Gdk = GLib = Gio = None
+GioMover = None
+yaml = None
 
 APP = 'renametoix'
 LOCALE_DIR = "/usr/share/locale"
@@ -37,6 +36,12 @@ _ = gettext.gettext
 crenametoix.get_text_callback = _
 
 REVERT_RENAME_SH = "revert-rename.sh"
+REMOTE_MAX_JOBS = 4
+APPLICATION_ID = "com.devtoix.renametoix"
+# After the window is closed, the application waits for new files before exiting
+APPLICATION_INACTIVITY_TIMEOUT_MS = 5 * 60 * 1000
+# Options of the following processes that are applied to the fields of the running window
+FORWARDED_OPTIONS = ["find", "replace", "reg_ex", "include_ext", "start_index"]
 
 console_mode_text = _("Console Mode")
 arg_parser = crenametoix.get_argument_parser()
@@ -47,58 +52,117 @@ arg_parser.add_argument("-allow-revert", action='store_true', default=False,
                         help="%s (%s)" % (_("Generates a revert script"), console_mode_text))
 arg_parser.add_argument("-revert-last", action='store_true', default=False,
                         help=_("Reverts last rename and exits"))
+arg_parser.add_argument("-pipeline", metavar="NAME",
+                        help="%s (%s)" % (_("Runs the find replace steps of a pipeline saved "
+                                            "on the config"), console_mode_text))
 args = crenametoix.get_args_from_parse(arg_parser)
 
 
+def load_gio():
+    global GLib, Gio, GioMover
+    if Gio is None:
+        import gi
+        gi.require_version('Gio', '2.0')  # noqa
+        from gi.repository import GLib, Gio
+        from giomover import GioMover
+
+
+def load_gtk():
+    global Gtk, Gdk
+    load_gio()
+    if Gtk is None:
+        import gi
+        gi.require_version("Gtk", "3.0")  # noqa
+        from gi.repository import Gtk, Gdk
+
+
+def load_yaml():
+    global yaml
+    if yaml is None:
+        import yaml
+
+
+def is_remote_uri(uri):
+    return "://" in uri and not uri.startswith("file://")
+
+
 # ------------------------------------------------------------------------
 #                               ConsoleRename
 # ------------------------------------------------------------------------
 
 class ConsoleRename(crenametoix.PureConsoleRename):
-    def __init__(self, args):
+    def __init__(self, args, use_gio=None):
         super().__init__(args)
+        # Gio is only required to access non-native locations
+        self.use_gio = use_gio if use_gio is not None \
+            else any(is_remote_uri(uri) for uri in args.files)
+        if self.use_gio:
+            load_gio()
         self.cfg = {
             "version": 1.0,
             "revert-path": os.path.join(os.environ["HOME"], ".revert-renames"),
             "allow-revert": False,
             "send-notification": False,
-            "macros": list(crenametoix.macros.keys())
+            "macros": list(crenametoix.macros.keys()),
+            "pipelines": {}
         }
         self.default_macros = self.cfg["macros"]
-        self.cfg_name = os.path.join(GLib.get_user_config_dir(), 'renametoix', 'renametoix.yaml')
+        self.cfg_name = os.path.join(os.environ.get("XDG_CONFIG_HOME")
+                                     or os.path.join(os.environ["HOME"], ".config"),
+                                     'renametoix', 'renametoix.yaml')
         self.revert_file = None
-        self.load_cfg()
+        if not args.console or args.allow_revert or args.revert_last or args.pipeline:
+            self.load_cfg()
 
     def get_g_file(self, filename):
-        return Gio.File.new_for_path(filename)
+        return Gio.File.new_for_path(filename) if self.use_gio else super().get_g_file(filename)
 
     def get_g_file_from_uri(self, uri):
-        return Gio.File.new_for_commandline_arg(uri)
+        return Gio.File.new_for_commandline_arg(uri) if self.use_gio \
+            else super().get_g_file_from_uri(uri)
 
     def wait_until(self, callback):
         GLib.idle_add(callback, False)
 
     def rename_file(self, g_source, g_dest, is_native):
-        if is_native:
-            g_source.move(g_dest, Gio.FileCopyFlags.NONE, None, None, None, None)
+        if not self.use_gio or is_native:
+            super().rename_file(g_source, g_dest, is_native)
         else:
             try:
-                src_stream = g_source.read(None)
-                dest_stream = g_dest.replace(None, False, Gio.FileCreateFlags.NONE, None)
-                buffer_size = 8192
-                while True:
-                    data = src_stream.read_bytes(buffer_size, None)
-                    if data.get_size() == 0:
-                        break
-                    dest_stream.write_bytes(data, None)
-                src_stream.close(None)
-                dest_stream.close(None)
-                g_source.delete(None)
+                GioMover().move(g_source, g_dest)
             except GLib.Error as e:
                 print(f"Error during rename operation: {e}")
 
+    def defer_rename(self, g_source, g_dest, is_native):
+        return not is_native or super().defer_rename(g_source, g_dest, is_native)
+
+    def apply_deferred_renames(self, renames, is_silent):
+        # native files moved between file systems are copied by the local move engine
+        native_renames = [rename for rename in renames if rename[4]]
+        if native_renames:
+            super().apply_deferred_renames(native_renames, is_silent)
+        remote_renames = [rename for rename in renames if not rename[4]]
+        if not remote_renames:
+            return
+        mover = GioMover(REMOTE_MAX_JOBS, None if is_silent else self.report_progress)
+        for src_file, dst_file, g_source, g_dest, is_native, error in \
+                mover.move_all(remote_renames):
+            if error:
+                sys.stderr.write(f"Error during rename operation: {error}\n")
+                continue
+            self.after_rename(src_file, dst_file, is_native)
+            self.rename_count += 1
+            self.report_rename(src_file, dst_file, is_silent)
+
+    def report_progress(self, done_count, total_count, copied_bytes):
+        if sys.stderr.isatty():
+            sys.stderr.write("\r" + _("%d of %d files moved") % (done_count, total_count)
+                             + f" ({copied_bytes // (1024 * 1024)} MB)"
+                             + ("\n" if done_count == total_count else ""))
+
     def load_cfg(self):
         if os.path.isfile(self.cfg_name):
+            load_yaml()
             with io.open(self.cfg_name, "r", encoding="utf8") as input_file:
                 self.cfg = yaml.safe_load(input_file)
 
@@ -114,10 +178,18 @@ class ConsoleRename(crenametoix.PureConsoleRename):
                 time.strftime("%Y-%m-%d-%H_%M_%S.sh", time.localtime())
             self.revert_file = open(self.revert_name, "w")
             self.revert_file.write("echo Reverting Changes:\n\n")
+            if self.args.durable:
+                # the new revert script is on the disk once its folder is synced
+                self.durable_folders.add(self.cfg["revert-path"])
 
         self.revert_file.write(f"printf \"'{new_basename}' → '{basename}'\\n\" 2>/dev/null\n"
                                f"mv '{new_fullname}' '{fullname}'\n")
 
+    def sync_journal(self):
+        if self.revert_file and not self.revert_file.closed:
+            self.revert_file.flush()
+            os.fsync(self.revert_file.fileno())
+
     def exec_revert_script(self, revert_basename=None):
         revert_script = self.get_revert_script(revert_basename)
         if not revert_basename and not os.path.exists(revert_script):
@@ -142,12 +214,20 @@ class ConsoleRename(crenametoix.PureConsoleRename):
 
     def close_revert_script(self):
         if self.rename_count and self.revert_file:
+            if self.args.durable:
+                self.sync_journal()
             self.revert_file.close()
             os.chmod(self.revert_name, stat.S_IEXEC | stat.S_IREAD | stat.S_IWRITE)
             main_revert_name = self.get_revert_script()
             with open(main_revert_name, "w") as main_revert_file:
                 main_revert_file.write(f"{self.revert_name}\n")
+                if self.args.durable:
+                    main_revert_file.flush()
+                    os.fsync(main_revert_file.fileno())
             os.chmod(main_revert_name, stat.S_IEXEC | stat.S_IREAD | stat.S_IWRITE)
+            if self.args.durable:
+                self.stats.count("fsync")
+                self.dir_fds.fsync(self.cfg["revert-path"])
 
     def get_revert_script(self, revert_basename=None):
         return os.path.join(self.cfg["revert-path"], revert_basename or REVERT_RENAME_SH)
@@ -175,8 +255,14 @@ class ConsoleRename(crenametoix.PureConsoleRename):
                 self.close_revert_script()
 
     def console_mode_rename(self):
-        if args.revert_last:
+        if self.args.revert_last:
             exit(self.exec_revert_script())
+        if self.args.pipeline:
+            steps = (self.cfg.get("pipelines") or {}).get(self.args.pipeline)
+            if not steps:
+                self.write_error(_("Unknown pipeline") + f" {self.args.pipeline}")
+                exit(1)
+            self.set_pipeline(steps)
         super().console_mode_rename()
 
     def after_rename(self, src_file, dst_file, is_native):
@@ -263,8 +349,14 @@ Quote=single""")
 
 class GUIRename(ConsoleRename):
 
-    def __init__(self, args):
-        super().__init__(args)
+    def __init__(self, args, application):
+        load_gtk()
+        super().__init__(args, True)
+        # -jobs is only used on console mode, forking the GTK process isn't safe
+        self.args.jobs = 1
+        self.queue_lazy_prepares = True
+        self.application = application
+        self.is_open = False
         self.ready = False
         self.append_new_default_macros()
         self.sort_column = None
@@ -352,13 +444,8 @@ class GUIRename(ConsoleRename):
         self.connect("open_revert_folder_button", [[self.open_revert_folder_button_clicked]])
         self.about_dialog = self.builder.get_object("about_dialog")
 
-        self.start_index_label_spin.set_value(self.args.start_index)
-        self.reg_ex_button.set_active(self.args.reg_ex)
-        self.include_ext_button.set_active(self.args.include_ext)
-        self.find_entry.set_text(self.args.find)
-        self.replace_entry.set_text(self.args.replace)
+        self.set_fields()
         self.add_accelerators()
-        self.add_source_files()
 
         self.drop_box = self.files_treeview
         entry_uri = Gtk.TargetEntry.new("text/uri-list", 0, 0)
@@ -369,10 +456,8 @@ class GUIRename(ConsoleRename):
 
         screen = Gdk.Display.get_default().get_monitor(0).get_geometry()
         self.app_window.set_default_size(screen.width, screen.height - 100)
-        self.app_window.connect("delete-event", Gtk.main_quit)
-        self.app_window.show_all()
+        self.app_window.connect("delete-event", self.close_window)
         self.ready = True
-        self.update_renames()
 
     # Events
 
@@ -559,8 +644,51 @@ class GUIRename(ConsoleRename):
             self.console_apply_renames(allow_revert=self.cfg["allow-revert"], is_silent=True)
             self.notify_msg(_("%d files renamed") % self.rename_count)
 
-    def close_window(self, widget=None):
-        Gtk.main_quit()
+    def set_fields(self, options=None):
+        values = dict(vars(self.args), **(options or {}))
+        self.start_index_label_spin.set_value(values["start_index"])
+        self.reg_ex_button.set_active(values["reg_ex"])
+        self.include_ext_button.set_active(values["include_ext"])
+        self.find_entry.set_text(values["find"])
+        self.replace_entry.set_text(values["replace"])
+
+    def open_files(self, uris, options=None):
+        if options:
+            self.ready = False
+            self.set_fields(options)
+            self.ready = True
+        self.add_files(uris)
+        if not self.is_open:
+            # the application runs while the window is open
+            self.is_open = True
+            self.application.hold()
+            self.app_window.show_all()
+        self.app_window.present()
+
+    def close_window(self, widget=None, event=None):
+        # the window is hidden and the files cleared, the plugins and their caches
+        # stay loaded for the files opened before the inactivity timeout
+        self.app_window.hide()
+        self.reset_files()
+        if self.is_open:
+            self.is_open = False
+            self.application.release()
+        return True
+
+    def reset_files(self):
+        self.ready = False
+        self.files_list_store.clear()
+        self.files.clear()
+        self.files_state.clear()
+        self.renames.clear()
+        self.rename_count = 0
+        self.prepared_files_count = 0
+        self.allow_renames = False
+        self.exception = None
+        self.render_key = None
+        self.clear_caches()
+        self.set_fields()
+        self.ready = True
 
     def confirmation_dialog(self, message):
         dialog = Gtk.MessageDialog(message_format=message)
@@ -597,6 +725,7 @@ class GUIRename(ConsoleRename):
         cfg_path = os.path.dirname(self.cfg_name)
         if not os.path.isdir(cfg_path):
             os.makedirs(cfg_path)
+        load_yaml()
         with open(self.cfg_name, "wt", encoding="utf8") as output_file:
             output_file.write(yaml.dump(self.cfg, default_flow_style=False, sort_keys=False,
                                         allow_unicode=True, encoding="utf-8",
@@ -616,10 +745,18 @@ class GUIRename(ConsoleRename):
         for macro in macros:
             menuitem = Gtk.MenuItem(label=macro, visible=True)
             macro_description = crenametoix.macros.get(macro)
-            menuitem.set_tooltip_text(_(macro_description) if macro_description else tooltip)
+            # the plugins fields are read from the registry without importing the plugins
+            fields_description = crenametoix.plugin_registry.get_fields_description(macro)
+            menuitem.set_tooltip_text("\n".join(
+                text for text in [_(macro_description) if macro_description else tooltip,
+                                  fields_description] if text))
             menuitem.connect("activate", self.macro_button_clicked)
             macros_popup.append(menuitem)
 
+    def get_find_fields(self):
+        return self.reg_ex_button.get_active(), self.include_ext_button.get_active(), \
+            self.find_entry.get_text()
+
     def update_rename_ready(self, is_sync):
         self.ready = True
         self.thread_running = False
@@ -631,6 +768,9 @@ class GUIRename(ConsoleRename):
             self.replace_entry.get_text()
         )
         self.visual_allow_renames(self.allow_renames)
+        if any(plugin.queued_files for plugin in self.plugins.values()):
+            # the files evaluated before being prepared are prepared on a new batch
+            self.update_renames()
 
     def update_renames(self, widget=None):
         if self.ready:
@@ -644,9 +784,71 @@ class GUIRename(ConsoleRename):
         self.add_files_button.set_sensitive(not self.thread_running)
 
 
+# ------------------------------------------------------------------------
+#                               RenameApplication
+# ------------------------------------------------------------------------
+
+class RenameApplication:
+    # The first process owns the application id on D-Bus, the following processes only
+    # send their files to it and exit, without loading Gtk, the UI, the config or the plugins
+    def __init__(self, args):
+        load_gio()
+        self.args = args
+        self.gui = None
+        self.options = None
+        self.application = Gio.Application(application_id=APPLICATION_ID,
+                                           flags=Gio.ApplicationFlags.HANDLES_OPEN)
+        self.application.set_inactivity_timeout(APPLICATION_INACTIVITY_TIMEOUT_MS)
+        self.application.connect("activate", self.on_activate)
+        self.application.connect("open", self.on_open)
+        set_options_action = Gio.SimpleAction.new("set-options", GLib.VariantType.new("s"))
+        set_options_action.connect("activate", self.on_set_options)
+        self.application.add_action(set_options_action)
+
+    def run(self):
+        self.application.register(None)
+        if self.application.get_is_remote():
+            self.forward_options()
+        # the files are sent on the D-Bus open message, "--" keeps them from being options
+        return self.application.run([sys.argv[0], "--"] + self.args.files)
+
+    def forward_options(self):
+        # the options given on the command line are sent before the files, the ones that
+        # the running window can't change are reported
+        options = {}
+        ignored_options = []
+        for name, value in vars(self.args).items():
+            if name == "files" or value == arg_parser.get_default(name):
+                continue
+            if name in FORWARDED_OPTIONS:
+                options[name] = value
+            else:
+                ignored_options.append("-" + name.replace("_", "-"))
+        if ignored_options:
+            sys.stderr.write(_("Warning") + ": " + _("The running instance ignores the options")
+                             + f" {' '.join(ignored_options)}\n")
+        if options:
+            self.application.activate_action("set-options", GLib.Variant("s", json.dumps(options)))
+
+    def on_set_options(self, action, parameter):
+        self.options = json.loads(parameter.get_string())
+
+    def on_activate(self, application):
+        self.open_files([])
+
+    def on_open(self, application, g_files, n_files, hint):
+        self.open_files([g_file.get_uri() for g_file in g_files])
+
+    def open_files(self, uris):
+        if self.gui is None:
+            self.gui = GUIRename(self.args, self.application)
+        options, self.options = self.options, None
+        self.gui.open_files(uris, options)
+
+
 if not args.console and not args.revert_last:
+    import setproctitle
     setproctitle.setproctitle("renametoix")
-    win = GUIRename(args)
-    Gtk.main()
+    sys.exit(RenameApplication(args).run())
 else:
-    ConsoleRename(args).console_mode_rename()
+    crenametoix.profile_console_rename(ConsoleRename(args))